@@ -0,0 +1,208 @@
+import json
+import os
+import urllib.parse
+import entsoe.entsoe
+import numpy as np
+import pandas as pd
+from fmiopendata.wfs import STORED_QUERY_URL
+from src import fingridapi, transport
+from src.datasets import generation_mapping
+from src.ratelimit import TokenBucket
+
+
+"""
+Offline fixture responses for the Fingrid, ENTSO-E and FMI clients. Responses are built from the recorded data in the
+seed CSV files (wind production and capacity, Finnish day-ahead prices and temperatures) and served through the shared
+transport in the formats of the APIs, so the benchmarks exercise the real request, parsing and transformation code
+with realistic values without network access.
+"""
+
+WIND_FILE = './data/old_wind_corr_data.csv'
+PRICE_FILE = './data/old_finnish_price_data.csv'
+TEMPERATURE_FILE = './data/old_temperatures.csv'
+
+# Last day fully covered by the recorded data
+FIXTURE_END = pd.Timestamp('2024-09-17').date()
+
+# Real-time generation datasets are published every 3 minutes, the rest hourly
+THREE_MINUTE_DATASETS = set(generation_mapping.values())
+# Recorded column served for a dataset, every other dataset is served the recorded wind production
+RECORDED_COLUMNS = {75: 'Tuulituotanto', 268: 'Kapasiteetti'}
+
+
+def _read_recorded(path, utc=True):
+    df = pd.read_csv(path)
+    df['Aikaleima'] = pd.to_datetime(df['Aikaleima'], utc=utc)
+    return df.set_index('Aikaleima').sort_index()
+
+
+class FingridFixture:
+    """
+    Transport serving the requests of src/fingridapi.py. Data rows are rendered once per dataset resolution and
+    recorded column, after that pages are served by slicing the rendered rows.
+    """
+
+    def __init__(self):
+        self.wind = _read_recorded(WIND_FILE)
+        self.requests = 0
+        self._rows = {}
+
+    def _rendered(self, freq, column):
+        if (freq, column) not in self._rows:
+            recorded = self.wind[column].resample('H').mean().interpolate()
+            if freq != 'H':
+                recorded = recorded.resample(freq).interpolate()
+            times = recorded.index.tz_localize(None).to_numpy()
+            step = pd.Timedelta(hours=1) if freq == 'H' else pd.Timedelta(freq)
+            start_times = np.datetime_as_string(times, unit='ms')
+            end_times = np.datetime_as_string(times + step.to_numpy(), unit='ms')
+            rows = [f'{{"startTime":"{start}Z","endTime":"{end}Z","value":{value:.1f}}}'.encode()
+                    for start, end, value in zip(start_times, end_times, recorded.to_numpy())]
+            self._rows[(freq, column)] = (times.astype('datetime64[ns]').view(np.int64), rows)
+        return self._rows[(freq, column)]
+
+    def prepare(self):
+        """
+        Render the rows of every resolution in advance, so rendering is not included in the measurements
+        """
+        for freq in ('H', '3min'):
+            self._rendered(freq, 'Tuulituotanto')
+        self._rendered('H', 'Kapasiteetti')
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests += 1
+        path, query = url.split('?', 1)
+        params = dict(urllib.parse.parse_qsl(query))
+        if 'search' in params:
+            return transport.response(url, 200, json.dumps({'data': []}).encode())
+        variableid = int(path.split('/datasets/')[1].split('/')[0])
+        freq = '3min' if variableid in THREE_MINUTE_DATASETS else 'H'
+        times, rows = self._rendered(freq, RECORDED_COLUMNS.get(variableid, 'Tuulituotanto'))
+        start = pd.Timestamp(params['startTime']).tz_convert(None).value
+        end = pd.Timestamp(params['endTime']).tz_convert(None).value
+        # End time is inclusive like in the API
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, end, side='right')
+        page_size, page = int(params['pageSize']), int(params.get('page', 1))
+        num_of_pages = max(1, -(-(last - first) // page_size))
+        page_rows = rows[first + (page - 1) * page_size:min(last, first + page * page_size)]
+        content = (b'{"data":[' + b','.join(page_rows) + b'],"pagination":{"lastPage":' +
+                   str(num_of_pages).encode() + b'}}')
+        return transport.response(url, 200, content)
+
+
+# Recorded prices are served for every area, wrapped in a day-ahead price document like the ones of ENTSO-E
+ENTSOE_DOCUMENT = (b'<?xml version="1.0" encoding="UTF-8"?><Publication_MarketDocument '
+                   b'xmlns="urn:iec62325.351:tc57wg16:451-3:publicationdocument:7:3">{series}'
+                   b'</Publication_MarketDocument>')
+ENTSOE_SERIES = ('<TimeSeries><mRID>1</mRID><businessType>A62</businessType><currency_Unit.name>EUR'
+                 '</currency_Unit.name><price_Measure_Unit.name>MWH</price_Measure_Unit.name><curveType>A03'
+                 '</curveType><Period><timeInterval><start>{start}</start><end>{end}</end></timeInterval>'
+                 '<resolution>PT60M</resolution>{points}</Period></TimeSeries>')
+ENTSOE_NO_DATA = (b'<?xml version="1.0" encoding="UTF-8"?><Acknowledgement_MarketDocument><Reason><code>999</code>'
+                  b'<text>No matching data found for Data item Day-ahead Prices</text></Reason>'
+                  b'</Acknowledgement_MarketDocument>')
+
+# Coordinates of the recorded stations, the observations of a station are identified by them
+FMI_STATIONS = {'Helsinki': (60.17523, 24.94459), 'Jämsä': (61.86507, 25.19028), 'Oulu': (65.04113, 25.41815),
+                'Rovaniemi': (66.49667, 25.74389)}
+FMI_DOCUMENT = ('<?xml version="1.0" encoding="UTF-8"?><wfs:FeatureCollection '
+                'xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" '
+                'xmlns:gmlcov="http://www.opengis.net/gmlcov/1.0" '
+                'xmlns:swe="http://www.opengis.net/swe/2.0"><wfs:member>{points}<gml:DataBlock>'
+                '<gml:doubleOrNilReasonTupleList>{values}</gml:doubleOrNilReasonTupleList></gml:DataBlock>'
+                '<gmlcov:positions>{positions}</gmlcov:positions><swe:DataRecord><swe:field name="T"><swe:label>'
+                'Air temperature</swe:label><swe:uom code="Cel"/></swe:field></swe:DataRecord></wfs:member>'
+                '</wfs:FeatureCollection>')
+FMI_POINT = ('<gml:Point gml:id="point-{id}"><gml:name>{name}</gml:name><gml:pos>{latitude} {longitude} </gml:pos>'
+             '</gml:Point>')
+
+
+class EntsoeFixture:
+    """
+    Transport serving the day-ahead price queries of EntsoePandasClient, every area is served the recorded Finnish
+    prices
+    """
+
+    def __init__(self):
+        self.prices = _read_recorded(PRICE_FILE)['FI']
+        self.requests = 0
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests += 1
+        start = pd.Timestamp(params['periodStart'], tz='UTC')
+        end = pd.Timestamp(params['periodEnd'], tz='UTC')
+        prices = self.prices[(self.prices.index >= start) & (self.prices.index < end)]
+        if prices.empty:
+            return transport.response(url, 200, ENTSOE_NO_DATA, {'Content-Type': 'application/xml'})
+        # Missing hours are left out, which curve type A03 repeats from the previous hour
+        hours = prices.index.tz_convert('UTC')
+        positions = (hours - hours[0]) // pd.Timedelta(hours=1) + 1
+        points = ''.join(f'<Point><position>{position}</position><price.amount>{price}</price.amount></Point>'
+                         for position, price in zip(positions, prices.to_numpy()))
+        series = ENTSOE_SERIES.format(start=f'{hours[0]:%Y-%m-%dT%H:%MZ}',
+                                      end=f'{hours[-1] + pd.Timedelta(hours=1):%Y-%m-%dT%H:%MZ}', points=points)
+        return transport.response(url, 200, ENTSOE_DOCUMENT.replace(b'{series}', series.encode()),
+                                  {'Content-Type': 'application/xml'})
+
+
+class FmiFixture:
+    """
+    Transport serving the multipoint coverage queries of src/fmi_api.py with the recorded station temperatures
+    """
+
+    def __init__(self):
+        self.temperatures = _read_recorded(TEMPERATURE_FILE, utc=False)
+        self.requests = 0
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests += 1
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+        start = pd.Timestamp(query['starttime'].rstrip('Z'))
+        end = pd.Timestamp(query['endtime'].rstrip('Z'))
+        window = self.temperatures.loc[start:end, [station for station in FMI_STATIONS
+                                                   if station in self.temperatures.columns]]
+        seconds = (window.index - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+        # Observations are listed station by station like in the responses of FMI
+        positions, values = [], []
+        for station in window.columns:
+            latitude, longitude = FMI_STATIONS[station]
+            positions.extend(f'{latitude} {longitude} {second}' for second in seconds)
+            values.extend(str(value) for value in window[station].to_numpy())
+        points = ''.join(FMI_POINT.format(id=number, name=f'{station} asema', latitude=latitude, longitude=longitude)
+                         for number, (station, (latitude, longitude)) in enumerate(FMI_STATIONS.items()))
+        content = FMI_DOCUMENT.format(points=points, values=' '.join(values), positions=' '.join(positions))
+        return transport.response(url, 200, content.encode(), {'Content-Type': 'text/xml'})
+
+
+class FixtureTransport:
+    """
+    Transport routing the requests of each client to its fixture by the host name
+    """
+
+    def __init__(self, fixtures):
+        """
+        :param fixtures: dictionary of host name -> fixture transport
+        """
+        self.fixtures = fixtures
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        return self.fixtures[urllib.parse.urlsplit(url).hostname].get(url, params=params, headers=headers, **kwargs)
+
+
+def install():
+    """
+    Serve the requests of all three clients from the fixtures through the shared transport, so the clients run their
+    real request, parsing and retry code. Fingrid rate limiting is disabled, so the measurements show the cost of the
+    data processing instead of waiting for the limiter.
+    :return: dictionary of client name -> fixture
+    """
+    # Clients refuse to run without API keys although the fixtures don't check them
+    os.environ.setdefault('FGAPIKEY', 'fixture')
+    os.environ.setdefault('ENTSO_TOKEN', 'fixture')
+    fixtures = {'fingrid': FingridFixture(), 'entsoe': EntsoeFixture(), 'fmi': FmiFixture()}
+    hosts = {fingridapi.FG_API_URL: 'fingrid', entsoe.entsoe.URL: 'entsoe', STORED_QUERY_URL: 'fmi'}
+    transport.set_transport(FixtureTransport({urllib.parse.urlsplit(url).hostname: fixtures[name]
+                                              for url, name in hosts.items()}))
+    fingridapi._limiter = TokenBucket(rate=1e9, capacity=1e9)
+    return fixtures
@@ -0,0 +1,198 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import streamlit.logger
+# Streamlit warns about every cached function used without a running app, also when they are defined
+streamlit.logger.set_log_level('error')
+from benchmarks import fixtures
+from src import cache, charts, datasets, entsoapi, fingridapi, fmi_api, metrics, storage
+from src.general_functions import aggregate_data
+from src.trendline import binned_lowess
+
+
+"""
+Offline benchmarks of the data loaders and transformations behind the pages. Upstream APIs are replaced with fixtures
+(benchmarks/fixtures.py) and every run uses an empty temporary store. Run from the repository root:
+
+    python -m benchmarks.run                  # compare against benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline  # store the results as the new baseline
+    python -m benchmarks.run --memory-report  # also show the memory saved by compact dtypes per dataset
+
+Each case is measured cold (empty store and caches, i.e. data is fetched and decoded), warm (store already filled,
+in-memory caches cleared) and for the peak memory of a cold run. Wall times are the fastest of several repeated runs,
+as the slower runs only add noise from the rest of the machine. Exit code is 1 if a measurement regressed.
+"""
+
+BASELINE_FILE = './benchmarks/baseline.json'
+HISTORY_START = datetime.date(2018, 1, 1)
+RANGES = {'month': datetime.timedelta(days=30), 'year': datetime.timedelta(days=365), 'full': None}
+AREAS = ['FI', 'SE1', 'EE']
+
+# Full history of the 3 minute generation datasets needs several gigabytes, so it is left out
+CASE_RANGES = {'get_generations_df': ['month', 'year']}
+
+# Runs per case, the fastest cold and warm times are reported
+REPEATS = 3
+
+# Differences smaller than these are treated as noise
+MIN_TIME_DIFFERENCE = 0.1
+MIN_MEMORY_DIFFERENCE = 5.0
+
+
+def _wind(start, end):
+    # Loads the wind frame both as a case of its own and as the input of the cases processing it
+    return datasets.get_wind_df(start, end)
+
+
+CASES = {
+    'get_wind_df': (None, lambda start, end, _: _wind(start, end)),
+    'get_demand_df': (None, lambda start, end, _: datasets.get_demand_df(start, end)),
+    'get_production_and_demand_df': (None, lambda start, end, _: datasets.get_production_and_demand_df(start, end)),
+    'get_generations_df': (None, lambda start, end, _: datasets.get_generations_df(start, end)),
+    'get_flows_and_capacities_df': (None, lambda start, end, _: datasets.get_flows_and_capacities_df(
+        start, end, datasets.estlink_map)),
+    'get_price_data': (None, lambda start, end, _: entsoapi.get_price_data(AREAS, start, end)),
+    'temperatures': (None, lambda start, end, _: fmi_api.temperatures(
+        datetime.datetime.combine(start, datetime.time()), datetime.datetime.combine(end, datetime.time()))),
+    'get_aggregated_data': (None, lambda start, end, _: datasets.get_aggregated_data(start, end, 'Päivä',
+                                                                                     with_price=True)),
+    'aggregate_data': (_wind, lambda start, end, df: aggregate_data(df, 'Päivä')),
+    'downsample': (_wind, lambda start, end, df: charts.downsample(df)),
+    'hour_grid': (_wind, lambda start, end, df: charts.hour_grid(df['Käyttöaste'], 'Päivä')),
+    'binned_lowess': (lambda start, end: datasets.get_aggregated_data(start, end, 'Tunti'),
+                      lambda start, end, df: binned_lowess(df['Keskilämpötila'], df['Käyttöaste'])),
+}
+
+
+def _date_range(name):
+    end = fixtures.FIXTURE_END
+    return (end - RANGES[name] if RANGES[name] is not None else HISTORY_START), end
+
+
+def _clear_memory_caches():
+    cache.clear()
+    with fingridapi._open_chunks_lock:
+        fingridapi._open_chunks.clear()
+
+
+@contextlib.contextmanager
+def _empty_store():
+    store_path = storage.STORE_PATH
+    storage.STORE_PATH = tempfile.mkdtemp(prefix='energiadata_benchmark_')
+    try:
+        yield
+    finally:
+        shutil.rmtree(storage.STORE_PATH, ignore_errors=True)
+        storage.STORE_PATH = store_path
+
+
+def _timed(function, *args):
+    # Downloaders print their progress, which is not interesting here
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - started
+
+
+def measure(case, range_name, repeats=REPEATS):
+    """
+    Measure a single case on a single date range
+    :param repeats: number of cold and warm runs, the fastest of them are reported
+    :return: dictionary with cold and warm wall times in seconds and the peak memory in megabytes
+    """
+    prepare, function = CASES[case]
+    start, end = _date_range(range_name)
+    cold, warm = [], []
+    for _ in range(max(1, repeats)):
+        with _empty_store():
+            _clear_memory_caches()
+            data = prepare(start, end) if prepare is not None else None
+            _clear_memory_caches()
+            cold.append(_timed(function, start, end, data))
+            _clear_memory_caches()
+            warm.append(_timed(function, start, end, data))
+    with _empty_store():
+        _clear_memory_caches()
+        data = prepare(start, end) if prepare is not None else None
+        _clear_memory_caches()
+        tracemalloc.start()
+        try:
+            _timed(function, start, end, data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'cold_s': round(min(cold), 3), 'warm_s': round(min(warm), 3), 'peak_mb': round(peak / 2 ** 20, 1)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results against the baseline
+    :return: list of (result key, metric, baseline value, new value) of the regressed measurements
+    """
+    regressions = []
+    for key, result in results.items():
+        for metric, value in result.items():
+            old = baseline.get(key, {}).get(metric)
+            if old is None:
+                continue
+            min_difference = MIN_MEMORY_DIFFERENCE if metric == 'peak_mb' else MIN_TIME_DIFFERENCE
+            if value > old * (1 + tolerance) and value - old > min_difference:
+                regressions.append((key, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the EnergiaData data pipelines')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--ranges', nargs='+', choices=list(RANGES), default=list(RANGES))
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=REPEATS, help='runs per case, the fastest times are reported')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative slowdown or memory growth')
+    parser.add_argument('--memory-report', action='store_true', help='show the memory saved by compact dtypes')
+    args = parser.parse_args()
+
+    storage.LOCAL_ONLY = False
+    fixtures.install()['fingrid'].prepare()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f'{"case":<32}{"range":<7}{"cold s":>9}{"warm s":>9}{"peak MB":>9}  baseline (cold/warm/MB)')
+    for case in args.cases:
+        for range_name in [name for name in args.ranges if name in CASE_RANGES.get(case, RANGES)]:
+            key = f'{case}/{range_name}'
+            results[key] = measure(case, range_name, args.repeat)
+            result, old = results[key], baseline.get(key)
+            reference = f'{old["cold_s"]:.3f}/{old["warm_s"]:.3f}/{old["peak_mb"]:.1f}' if old else '-'
+            print(f'{case:<32}{range_name:<7}{result["cold_s"]:>9.3f}{result["warm_s"]:>9.3f}'
+                  f'{result["peak_mb"]:>9.1f}  {reference}', flush=True)
+
+    if args.memory_report:
+        print(metrics.memory_report().to_string())
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for key, metric, old, value in regressions:
+        print(f'REGRESSION {key} {metric}: {old} -> {value}')
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
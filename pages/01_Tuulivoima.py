@@ -1,11 +1,14 @@
 import plotly.subplots
 import streamlit as st
-from streamlit_extras.chart_container import chart_container
 import plotly.express as px
 import numpy as np
-from src.general_functions import get_general_layout, aggregate_data
-from src.fingridapi import get_data_from_fg_api_with_start_end
+import pandas as pd
+from src.general_functions import get_general_layout, aggregate_data, show_data_freshness
+from src.datasets import get_demand_df, get_wind_df
 from src.entsoapi import get_finnish_price_data
+from src.charts import chart_container, downsample, zoom
+from src.align import align, describe
+from src import metrics
 
 st.set_page_config(
     page_title="EnergiaData - Tuuli- ja sähköjärjestelmätilastoja",
@@ -15,45 +18,8 @@ st.set_page_config(
 )
 
 
-@st.cache_data(show_spinner=False, max_entries=200)
-def get_demand_df(start, end):
-    """
-    Get the demand values from Fingrid API between the start and end dates
-    :param start: start date
-    :param end: end date
-    :return: demand dataframe
-    """
-    demand_df = get_data_from_fg_api_with_start_end(124, start, end)
-    demand_df.rename({'Value': 'Kulutus'}, axis=1, inplace=True)
-    return demand_df
-
-
-def get_wind_df(start, end):
-    """
-    Get the wind production and capacity values from Fingrid API between the start and end dates.
-    Calculates the utilization rate
-    :param start: start date
-    :param end: end date
-    :return: wind dataframe
-    """
-
-    df = get_data_from_fg_api_with_start_end(75, start, end)
-    df.rename({'Value': 'Tuulituotanto'}, axis=1, inplace=True)
-
-    wind_capacity = get_data_from_fg_api_with_start_end(268, start, end)
-    # Fixing issues in the API capacity (sometimes capacity is missing and API gives low value)
-    wind_capacity.loc[wind_capacity['Value'] < wind_capacity['Value'].shift(-24), 'Value'] = np.NaN
-    df['Kapasiteetti'] = wind_capacity['Value']
-    # Due to issues with input data with strange timestamps, we need to resample the data
-    df = df.resample('H')
-    # Interpolate missing values linearly
-    df = df.interpolate()
-
-    df['Käyttöaste'] = df['Tuulituotanto'] / df['Kapasiteetti'] * 100
-    return df.round(1)
-
-
 start_date, end_date, aggregation_selection = get_general_layout()
+show_data_freshness(['fingrid_75_recent', 'fingrid_268_recent', 'fingrid_124_recent', 'price_FI'])
 
 st.subheader('Tuulivoiman tilastoja')
 # Create tabs for different visualizations
@@ -66,7 +32,7 @@ with tab1:
     wind_df = get_wind_df(start_date, end_date)
     aggregated_wind = aggregate_data(wind_df, aggregation_selection)
     # Using chart_container that allows user to look into the data or download it from separate tabs
-    with chart_container(aggregated_wind, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_wind, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], key='wind'):
         # Wind production metrics and graph
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -76,7 +42,9 @@ with tab1:
         with col3:
             st.metric("Minimituotanto", f"{round(aggregated_wind['Tuulituotanto'].min(), 1)} MW")
         st.markdown("**Tuulivoimatuotanto ja asennettu kapasiteetti**")
-        fig = px.scatter(aggregated_wind, x=aggregated_wind.index, y=['Tuulituotanto', 'Kapasiteetti'],
+        # Min/max downsampling keeps the production peaks, so the record trend line stays correct
+        plot_wind = downsample(zoom(aggregated_wind, 'wind_zoom'), method='minmax')
+        fig = px.scatter(plot_wind, x=plot_wind.index, y=['Tuulituotanto', 'Kapasiteetti'],
                          trendline='expanding', trendline_options=dict(function="max"))
         fig.update_traces(mode='lines')
         fig.data[1].update(dict(name='Tuulivoimatuotannon ennätys', legendgroup=None, showlegend=True,
@@ -97,7 +65,7 @@ with tab1:
         with col3:
             st.metric("Minimikäyttöaste", f"{aggregated_wind['Käyttöaste'].min()} %")
         st.markdown("**Tuulivoimatuotannon käyttöaste (eli tuotanto/kapasiteetti)**")
-        fig = px.line(aggregated_wind, x=aggregated_wind.index, y=['Käyttöaste'])
+        fig = px.line(plot_wind, x=plot_wind.index, y=['Käyttöaste'])
         fig.update_traces(line=dict(width=2.5))
         fig.update_layout(legend_title="Aikasarja", yaxis=dict(title='%', range=[0, 100]))
         fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
@@ -110,7 +78,7 @@ with tab2:
     demand_df['Tuulituotannon osuus kulutuksesta'] = wind_df['Tuulituotanto']/demand_df['Kulutus'] * 100
     aggregated_demand = aggregate_data(demand_df, aggregation_selection)
     # Using chart_container that allows user to look into the data or download it from separate tabs
-    with chart_container(aggregated_demand, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_demand, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], key='demand'):
         st.subheader("Tuulituotannon osuus kulutuksesta")
 
         # Wind production metrics and graph
@@ -124,8 +92,9 @@ with tab2:
 
         subfig = plotly.subplots.make_subplots(specs=[[{"secondary_y": True}]])
 
-        fig = px.line(aggregated_demand, x=aggregated_demand.index, y=['Tuulituotannon osuus kulutuksesta'])
-        fig2 = px.line(aggregated_demand, x=aggregated_demand.index, y=['Kulutus'])
+        plot_demand = downsample(zoom(aggregated_demand, 'demand_zoom'))
+        fig = px.line(plot_demand, x=plot_demand.index, y=['Tuulituotannon osuus kulutuksesta'])
+        fig2 = px.line(plot_demand, x=plot_demand.index, y=['Kulutus'])
         fig2.update_traces(yaxis="y2")
         subfig.add_traces(fig.data + fig2.data)
         subfig.layout.xaxis.title = "Aika"
@@ -142,9 +111,11 @@ with tab2:
 with tab3:
     price_df = get_finnish_price_data(start_date, end_date)
     st.subheader("Tuulituotannon saama hinta valitulla aikavälillä.")
-    wind_price_df = wind_df.copy()
-    length = len(wind_price_df)
-    wind_price_df['Hinta'] = price_df.values[:length]
+    # Prices are matched to the production by hour, not by position, so gaps and DST changes can't shift them
+    price, alignment = align(price_df, wind_df.index)
+    if describe(alignment):
+        st.caption(f"Hintatiedot: {describe(alignment)}")
+    wind_price_df = pd.DataFrame({'Tuulituotanto': wind_df['Tuulituotanto'], 'Hinta': price})
     wind_price_df['CP'] = wind_price_df['Hinta'] * wind_price_df['Tuulituotanto']
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -178,3 +149,5 @@ with tab3:
     subfig.layout.yaxis2.tickformat = ".1f"
     subfig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
     st.plotly_chart(subfig, use_container_width=True)
+
+metrics.show_debug_panel()
@@ -1,13 +1,13 @@
-import pandas as pd
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objs as go
-from streamlit_extras.chart_container import chart_container
 from streamlit_extras.toggle_switch import st_toggle_switch
-from src.fingridapi import get_data_from_fg_api_with_start_end
-from src.general_functions import get_general_layout, aggregate_data
+from src.general_functions import get_general_layout, aggregate_data, show_data_freshness
+from src.datasets import estlink_map, fennoskan_map, rac_map, get_flows_and_capacities_df
+from src.charts import chart_container, downsample, zoom
+from src.dtypes import calendar_field
+from src import metrics
 from datetime import datetime, time, timedelta
-import time
 
 st.set_page_config(
     page_title="EnergiaData - Suomen siirtoyhteyksien tilastoja",
@@ -17,58 +17,25 @@ st.set_page_config(
 )
 
 
-@st.cache_data(show_spinner=False, max_entries=200)
-def get_flows_and_capacities_df(start, end, flow_mapping):
-    """
-    Get the commercial flows and capacity values from Fingrid API between the start and end dates
-    :param start: start date
-    :param end: end date
-    :return: production dataframe with demand values included
-    """
-
-    dfs = []
-    for key, value in flow_mapping.items():
-        df = get_data_from_fg_api_with_start_end(value, start, end)
-        time.sleep(1)
-        df.rename({'Value': key}, axis=1, inplace=True)
-        dfs.append(df)
-
-    result = pd.concat(dfs, axis=1)
-    # export is expected to be positive always
-    result['Vientikapasiteetti'] = abs(result['Vientikapasiteetti'])
-    result['Tuontikapasiteetti'] = result['Tuontikapasiteetti'] * -1
-    return result
-
-
 start_date, end_date, aggregation_selection = get_general_layout()
 
 st.subheader('Suomen siirtoyhteyksien tilastoja')
 st.markdown("Positiiviset arvot kuvaavat vientiä Suomesta.")
 
-estlink_map = {'Kaupallinen siirto': 140,
-               'Vientikapasiteetti': 115,
-               'Tuontikapasiteetti': 112}
-
-fennoskan_map = {'Kaupallinen siirto': 32,
-                 'Vientikapasiteetti': 27,
-                 'Tuontikapasiteetti': 25}
-
-rac_map = {'Kaupallinen siirto': 31,
-           'Vientikapasiteetti': 26,
-           'Tuontikapasiteetti': 24}
+show_data_freshness([f'fingrid_{variableid}_recent' for mapping in (estlink_map, fennoskan_map, rac_map)
+                     for variableid in mapping.values()])
 
 estlink_df = get_flows_and_capacities_df(start_date, end_date, estlink_map)
 fennoskan_df = get_flows_and_capacities_df(start_date, end_date, fennoskan_map)
 rac_df = get_flows_and_capacities_df(start_date, end_date, rac_map)
 aggregated_estlink_df = aggregate_data(estlink_df, aggregation_selection)
-aggregated_estlink_df['Vuosi'] = aggregated_estlink_df.index.year.astype(str)
 split_years = None
 tab1, tab2, tab3 = st.tabs(['Suomi - Viro', 'Suomi - Pohjois-Ruotsi (SE1)', 'Suomi - Keski-Ruotsi (SE3)'])
 
 with tab1:
     st.markdown("EstLink")
     # Using chart_container that allows user to look into the data or download it from separate tabs
-    with chart_container(aggregated_estlink_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_estlink_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='estlink'):
         # Demand and production metrics and graph
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -78,7 +45,8 @@ with tab1:
         with col3:
             st.metric("Minimisiirto", f"{int(aggregated_estlink_df['Kaupallinen siirto'].min() + 0.5)} MW")
         st.markdown("**Suomen ja Viron välinen sähkönsiirto**")
-        fig = px.line(aggregated_estlink_df, x=aggregated_estlink_df.index,
+        plot_df = downsample(zoom(aggregated_estlink_df, 'estlink_zoom'))
+        fig = px.line(plot_df, x=plot_df.index,
                       y=['Kaupallinen siirto', 'Vientikapasiteetti', 'Tuontikapasiteetti'])
         fig.update_traces(line=dict(width=2.5))
         fig.update_layout(dict(yaxis_title='MW', legend_title="Aikasarja"))
@@ -86,20 +54,20 @@ with tab1:
         st.plotly_chart(fig, use_container_width=True)
         if st_toggle_switch("Laske jakauma eri vuosille?", default_value=True, label_after=True, key="esttab"):
             split_years = 'Vuosi'
-        fig = px.violin(aggregated_estlink_df, y='Kaupallinen siirto', x=split_years,
+        fig = px.violin(aggregated_estlink_df, y='Kaupallinen siirto',
+                        x=calendar_field(aggregated_estlink_df.index, split_years) if split_years else None,
                         title='Kaupallisen siirron jakauma')
         fig.update_layout(dict(xaxis_autorange=True, xaxis_tickformat=".n", yaxis_hoverformat=".1f"))
         st.plotly_chart(fig, use_container_width=True)
 
 aggregated_rac_df = aggregate_data(rac_df, aggregation_selection)
-aggregated_rac_df['Vuosi'] = aggregated_rac_df.index.year.astype(str)
 split_years = None
 
 with tab2:
     st.markdown("Suomen ja Ruotsin välinen vaihtosähköyhteys. "
                 "Data sisältää myös Suomen ja Norjan välisen pienen vaihtosähköyhteyden siirron.")
     # Using chart_container that allows user to look into the data or download it from separate tabs
-    with chart_container(aggregated_rac_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_rac_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='rac'):
         # Demand and production metrics and graph
 
         col1, col2, col3 = st.columns(3)
@@ -110,7 +78,8 @@ with tab2:
         with col3:
             st.metric("Minimisiirto", f"{int(aggregated_rac_df['Kaupallinen siirto'].min() + 0.5)} MW")
         st.markdown("**Suomen ja Pohjois-Ruotsin (+ Norjan) välinen sähkönsiirto**")
-        fig = px.line(aggregated_rac_df, x=aggregated_rac_df.index,
+        plot_df = downsample(zoom(aggregated_rac_df, 'rac_zoom'))
+        fig = px.line(plot_df, x=plot_df.index,
                       y=['Kaupallinen siirto', 'Vientikapasiteetti', 'Tuontikapasiteetti'])
         fig.update_traces(line=dict(width=2.5))
         fig.update_layout(dict(yaxis_title='MW', legend_title="Aikasarja"))
@@ -119,17 +88,18 @@ with tab2:
 
         if st_toggle_switch("Laske jakauma eri vuosille?", default_value=True, label_after=True, key="ractab"):
             split_years = 'Vuosi'
-        fig = px.violin(aggregated_rac_df, y='Kaupallinen siirto', x=split_years, title='Kaupallisen siirron jakauma')
+        fig = px.violin(aggregated_rac_df, y='Kaupallinen siirto',
+                        x=calendar_field(aggregated_rac_df.index, split_years) if split_years else None,
+                        title='Kaupallisen siirron jakauma')
         fig.update_layout(dict(xaxis_autorange=True, xaxis_tickformat=".n", yaxis_hoverformat=".1f"))
         st.plotly_chart(fig, use_container_width=True)
 
 aggregated_fennoskan_df = aggregate_data(fennoskan_df, aggregation_selection)
-aggregated_fennoskan_df['Vuosi'] = aggregated_fennoskan_df.index.year.astype(str)
 split_years = None
 
 with tab3:
     st.markdown("Fenno-Skan")
-    with chart_container(aggregated_fennoskan_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_fennoskan_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='fennoskan'):
         # Demand and production metrics and graph
 
         col1, col2, col3 = st.columns(3)
@@ -140,7 +110,8 @@ with tab3:
         with col3:
             st.metric("Minimisiirto", f"{int(aggregated_fennoskan_df['Kaupallinen siirto'].min() + 0.5)} MW")
         st.markdown("**Suomen ja Keski-Ruotsin välinen sähkönsiirto**")
-        fig = px.line(aggregated_fennoskan_df, x=aggregated_fennoskan_df.index,
+        plot_df = downsample(zoom(aggregated_fennoskan_df, 'fennoskan_zoom'))
+        fig = px.line(plot_df, x=plot_df.index,
                       y=['Kaupallinen siirto', 'Vientikapasiteetti', 'Tuontikapasiteetti'])
         fig.update_traces(line=dict(width=2.5))
         fig.update_layout(dict(yaxis_title='MW', legend_title="Aikasarja"))
@@ -149,14 +120,10 @@ with tab3:
 
         if st_toggle_switch("Laske jakauma eri vuosille?", default_value=True, label_after=True, key="fstab"):
             split_years = 'Vuosi'
-        fig = px.violin(aggregated_fennoskan_df, y='Kaupallinen siirto', x=split_years,
+        fig = px.violin(aggregated_fennoskan_df, y='Kaupallinen siirto',
+                        x=calendar_field(aggregated_fennoskan_df.index, split_years) if split_years else None,
                         title='Kaupallisen siirron jakauma')
         fig.update_layout(dict( xaxis_autorange=True, xaxis_tickformat=".n", yaxis_hoverformat=".1f"))
         st.plotly_chart(fig, use_container_width=True)
 
-
-
-
-
-
-
+metrics.show_debug_panel()
@@ -1,15 +1,15 @@
-import pandas as pd
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objs as go
 import plotly
-from streamlit_extras.chart_container import chart_container
-from src.fingridapi import get_data_from_fg_api_with_start_end
-from src.general_functions import get_general_layout, aggregate_data
+from src.general_functions import get_general_layout, aggregate_data, show_data_freshness
+from src.datasets import generation_mapping, get_production_and_demand_df, get_generations_df
 from fmiopendata.wfs import download_stored_query
 from datetime import datetime, time, timedelta
 from src.entsoapi import get_finnish_price_data
-import time
+from src.charts import chart_container, downsample, zoom
+from src.align import align, describe
+from src import metrics
 
 st.set_page_config(
     page_title="EnergiaData - Tuuli- ja sähköjärjestelmätilastoja",
@@ -19,61 +19,9 @@ st.set_page_config(
 )
 
 
-@st.cache_data(show_spinner=False, max_entries=200)
-def get_production_and_demand_df(start, end):
-    """
-    Get the production and  demand values from Fingrid API between the start and end dates
-    :param start: start date
-    :param end: end date
-    :return: production dataframe with demand values included
-    """
-    demand_df = get_data_from_fg_api_with_start_end(124, start, end)
-    demand_df.rename({'Value': 'Kulutus'}, axis=1, inplace=True)
-    production_df = get_data_from_fg_api_with_start_end(74, start, end)
-    production_df.rename({'Value': 'Tuotanto'}, axis=1, inplace=True)
-    production_df['Kulutus'] = demand_df['Kulutus']
-    production_df['Tase'] = production_df['Tuotanto'] - production_df['Kulutus']
-
-    # Due to issues with input data with strange timestamps, we need to resample the data
-    production_df = production_df.resample('H')
-    # Interpolate missing values linearly
-    production_df = production_df.interpolate()
-    return production_df
-
-@st.cache_data(show_spinner=False, max_entries=200)
-def get_generations_df(start, end):
-    """
-    Get the generation values from Fingrid API between the start and end dates
-    :param start: start date
-    :param end: end date
-    :return: production dataframe with demand values included
-    """
-    generation_mapping = {'Ydinvoima': 188,
-                          'Kaukolämmön yhteistuotanto': 201,
-                          'Teollisuuden yhteistuotanto': 202,
-                          'Muu tuotanto': 205,
-                          'Tuulivoima': 181,
-                          'Vesivoima': 191,
-                          'Nettotuonti/-vienti': 194,
-                          'Tuotanto': 192,
-                          'Kulutus': 193}
-
-    dfs = []
-    for key, value in generation_mapping.items():
-        df = get_data_from_fg_api_with_start_end(value, start, end)
-        time.sleep(1)
-        df.rename({'Value': key}, axis=1, inplace=True)
-        dfs.append(df)
-
-    result = pd.concat(dfs, axis=1)
-    # Solar production is not available from API but can be calculated
-    solar = result['Tuotanto'] - result[result.columns[0:6]].sum(axis=1)
-    result.insert(5, 'Aurinkovoima', solar)
-
-    return result
-
-
 start_date, end_date, aggregation_selection = get_general_layout()
+show_data_freshness([f'fingrid_{variableid}_recent' for variableid in (124, 74, *generation_mapping.values())] +
+                    ['price_FI'])
 
 st.subheader('Suomen tuotanto- ja kulutustilastoja')
 
@@ -83,7 +31,7 @@ tab1, tab2 = st.tabs(['Sähkön tuotanto ja kulutus', 'Suomen tuotantojakauma (3
 
 with tab1:
     # Using chart_container that allows user to look into the data or download it from separate tabs
-    with chart_container(aggregated_df, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
+    with chart_container(aggregated_df, ["Kuvaajat 📈", "Data 📄", "Lataa 📁"], key='production'):
         # Demand and production metrics and graph
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -96,7 +44,8 @@ with tab1:
             st.metric("Minimikulutus", f"{int(aggregated_df['Kulutus'].min() + 0.5)} MW")
             st.metric("Minimituotanto", f"{int(aggregated_df['Tuotanto'].min() + 0.5)} MW")
         st.markdown("**Suomen tuotanto ja kulutus**")
-        fig = px.line(aggregated_df, x=aggregated_df.index, y=['Tuotanto', 'Kulutus'])
+        plot_df = downsample(zoom(aggregated_df, 'production_zoom'))
+        fig = px.line(plot_df, x=plot_df.index, y=['Tuotanto', 'Kulutus'])
         fig.update_traces(line=dict(width=2.5))
         fig.update_layout(dict(yaxis_title='MW', legend_title="Aikasarja", yaxis_tickformat=".2r",
                                yaxis_hoverformat=".1f"))
@@ -123,14 +72,18 @@ with tab1:
     st.subheader("Kauppatase")
     st.write("Kauppatase = Nettotase * Suomen aluehinta samana ajankohtana")
     price_df = get_finnish_price_data(start_date, end_date)
-    trade_balance = prod_dem_df.copy()
-    trade_balance['Hinta'] = price_df.values[:len(trade_balance)]
+    # Prices are matched to the net balance by hour, not by position
+    price, alignment = align(price_df, prod_dem_df.index)
+    if describe(alignment):
+        st.caption(f"Hintatiedot: {describe(alignment)}")
+    trade_balance = prod_dem_df.assign(Hinta=price)
     trade_balance['Kauppatase'] = trade_balance['Tase'] * trade_balance['Hinta']
     # Interpolate missing values linearly
     result = trade_balance.interpolate()
     aggregated_df = aggregate_data(trade_balance, aggregation_selection, 'sum')
     st.metric("Kauppatase valitulla aikavälillä:", f"{round(aggregated_df['Kauppatase'].sum()/1000000, 1)} M€")
-    fig = px.line(aggregated_df, x=aggregated_df.index, y='Kauppatase')
+    plot_df = downsample(aggregated_df[['Kauppatase']])
+    fig = px.line(plot_df, x=plot_df.index, y='Kauppatase')
     st.plotly_chart(fig, use_container_width=True)
 
 with tab2:
@@ -143,10 +96,12 @@ with tab2:
     # Change net balance sign for visualization purposes
     generation_df['Nettotuonti/-vienti'] = generation_df['Nettotuonti/-vienti'] * -1
     #aggregated_df = aggregate_data(generation_df, aggregation_selection)
-    with chart_container(generation_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
-        fig = px.area(generation_df, x=generation_df.index, y=generation_df.columns[:-2])
-        fig.add_trace(go.Scatter(x=generation_df.index, y=generation_df['Tuotanto'], mode='lines'))
-        fig.add_trace(go.Scatter(x=generation_df.index, y=generation_df['Kulutus'], mode='lines'))
+    with chart_container(generation_df, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='generation'):
+        # All traces share the same downsampled timestamps, so the stacked areas stay aligned
+        plot_df = downsample(zoom(generation_df, 'generation_zoom'))
+        fig = px.area(plot_df, x=plot_df.index, y=plot_df.columns[:-2])
+        fig.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Tuotanto'], mode='lines'))
+        fig.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Kulutus'], mode='lines'))
         # Adjust coloring of lines
         # CHP
         fig.data[1]['line_color'] = "#000006"
@@ -163,6 +118,4 @@ with tab2:
         fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.04, xanchor="right", x=1))
         st.plotly_chart(fig, use_container_width=True)
 
-
-
-
+metrics.show_debug_panel()
@@ -1,93 +1,75 @@
-import plotly.subplots
 import streamlit as st
-from streamlit_extras.chart_container import chart_container
 from streamlit_extras.toggle_switch import st_toggle_switch
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
-import numpy as np
-from src.general_functions import get_general_layout, aggregate_data, check_previous_data
-from src.fmi_api import temperatures
-from src.fingridapi import get_data_from_fg_api_with_start_end
-from src.entsoapi import get_finnish_price_data
+from src.general_functions import get_general_layout, show_data_freshness
+from src.datasets import update_wind_corr_data, update_temperature_data, get_aggregated_data
+from src.entsoapi import update_finnish_price_data
+from src import metrics, storage
+from src.cache import cache_data
+from src.charts import chart_container, hour_grid
+from src.dtypes import calendar_field
+from src.trendline import binned_lowess
 import datetime
 
 
-def get_wind_df(start, end):
+@cache_data(show_spinner=False)
+def get_trendline(start, end, aggregation_selection, data_version):
     """
-    Get the wind production and capacity values from Fingrid API between the start and end dates.
-    Calculates the utilization rate
+    Fit the LOWESS trendline of utilization rate against temperature. The fitted curve is cached, so reruns only
+    draw it. Data version is only used as a part of the cache key, so the curve is refitted when new data is stored.
     :param start: start date
     :param end: end date
-    :return: wind dataframe
+    :param aggregation_selection: aggregation level
+    :param data_version: last update times of the used series
+    :return: dataframe with the temperatures and fitted utilization rates of the curve
     """
-    old_df = pd.read_csv('./data/old_wind_corr_data.csv')
-    old_df['Aikaleima'] = pd.to_datetime(old_df['Aikaleima'])
-    old_df.set_index(['Aikaleima'], inplace=True)
-    new_start_time = check_previous_data(old_df, start)
-
-    if new_start_time <= pd.to_datetime(end):
-        new_df = get_data_from_fg_api_with_start_end(75, new_start_time, end)
-
-        new_df.rename({'Value': 'Tuulituotanto'}, axis=1, inplace=True)
-
-        wind_capacity = get_data_from_fg_api_with_start_end(268, new_start_time, end)
-        # Fixing issues in the API capacity (sometimes capacity is missing and API gives low value)
-        wind_capacity.loc[wind_capacity['Value'] < wind_capacity['Value'].shift(-24), 'Value'] = np.NaN
-        new_df['Kapasiteetti'] = wind_capacity['Value']
-        # Due to issues with input data with strange timestamps, we need to resample the data
-        new_df = new_df.resample('H')
-        # Interpolate missing values linearly
-        new_df = new_df.interpolate('time')
-        new_df = pd.concat([old_df, new_df])
-        duplicates = new_df.index.duplicated()
-        if duplicates.any():
-            print("There are duplicate index values.")
-
-            # Option 1: Remove duplicates
-            df_no_duplicates = new_df[~duplicates]
-
-            # Option 2: Aggregate duplicates
-            new_df = new_df.groupby(new_df.index).last()
-        new_df.to_csv('./data/old_wind_corr_data.csv')
-
-    else:
-        new_df = old_df
-    new_df['Käyttöaste'] = new_df['Tuulituotanto'] / new_df['Kapasiteetti'] * 100
-    # Filter wind data based on the selected date if we have more data already downloaded
-    start = pd.to_datetime(start)
-    end = pd.to_datetime(end)
-
-    return new_df.loc[start:end].round(1)
+    df = get_aggregated_data(start, end, aggregation_selection)
+    x, y = binned_lowess(df['Keskilämpötila'], df['Käyttöaste'])
+    return pd.DataFrame({'Keskilämpötila': x, 'Käyttöaste': y})
 
 
-def get_temperatures(start_time, end_date):
-    old_df = pd.read_csv('./data/old_temperatures.csv')
-    old_df['Aikaleima'] = pd.to_datetime(old_df['Aikaleima'])
-    old_df.set_index(['Aikaleima'], inplace=True)
-    new_start_time = check_previous_data(old_df, start_time)
+@cache_data(show_spinner=False)
+def get_heatmap_grid(series, column, start, end, aggregation_selection, data_version):
+    """
+    Average the stored series by hour of day and period for the heatmaps. Data version is only used as a part of the
+    cache key.
+    :param series: stored series name
+    :param column: column to average, Käyttöaste is calculated from the wind production and capacity
+    :param start: start date
+    :param end: end date
+    :param aggregation_selection: aggregation level
+    :param data_version: last update time of the series
+    :return: dataframe with hours of day as rows and periods as columns
+    """
+    start = pd.to_datetime(start).tz_localize('Europe/Helsinki')
+    end = pd.to_datetime(end).tz_localize('Europe/Helsinki') + pd.to_timedelta(1, 'day')
+    df = storage.read(series, start, end)
+    if column == 'Käyttöaste':
+        df['Käyttöaste'] = df['Tuulituotanto'] / df['Kapasiteetti'] * 100
+    values = df.loc[df.index < end, column]
+    values.index = values.index.tz_convert('Europe/Helsinki')
+    return hour_grid(values, aggregation_selection).round(1)
+
+
+@metrics.timed('chart.heatmap')
+def plot_heatmap(grid, name, value_range, unit=''):
+    """
+    Draw the hour of day grid as a heatmap
+    :param grid: dataframe from get_heatmap_grid
+    :param name: name of the value
+    :param value_range: color scale range
+    :param unit: unit shown after the values
+    """
+    fig = go.Figure(go.Heatmap(z=grid.to_numpy(), x=grid.columns, y=grid.index, zmin=value_range[0],
+                               zmax=value_range[1], colorscale=px.colors.diverging.balance,
+                               colorbar=dict(title=name + (f' {unit}' if unit else '')),
+                               hovertemplate=f'Aika=%{{x}}<br>Tunti=%{{y}}<br>{name}=%{{z:.1f}}{unit}<extra></extra>'))
+    fig.update_layout(dict(height=600, xaxis_autorange=True, xaxis_title='Aika', yaxis_title='Tunti',
+                           yaxis_dtick=1))
+    st.plotly_chart(fig, use_container_width=True)
 
-    # Fetch new data only if there's a gap between old data and end_time
-    if new_start_time <= pd.to_datetime(end_date):
-        new_df = temperatures(new_start_time, end_date)
-    else:
-        new_df = pd.DataFrame()
-    end_time = pd.to_datetime(end_date).tz_localize('Europe/Helsinki')
-    start_time = pd.to_datetime(start_time).tz_localize('Europe/Helsinki')
-    # Combine old and new data
-    temperature_df = pd.concat([old_df, new_df])
-    temperature_df.to_csv('./data/old_temperatures.csv')
-    wind_df = get_wind_df(start_time, end_time)
-    #wind_df.index = pd.to_datetime(wind_df.index)
-    temperature_df['Keskilämpötila'] = temperature_df.mean(axis=1)
-    temperature_df.index = temperature_df.index.tz_localize('UTC')
-    temperature_df.index = temperature_df.index.tz_convert('Europe/Helsinki')
-    filtered_temp_df = temperature_df.loc[start_time:end_time]
-    wind_df.index = pd.to_datetime(wind_df.index, utc=True)
-    wind_df.index = wind_df.index.tz_convert('Europe/Helsinki')
-    filtered_wind_df = wind_df.loc[start_time:end_time]
-
-    filtered_df = pd.merge_asof(filtered_temp_df, filtered_wind_df, left_index=True, right_index=True)
-    return filtered_df[pd.to_datetime(start_time):pd.to_datetime(end_time)]
 
 st.set_page_config(
     page_title="EnergiaData - Tuuli- ja sähköjärjestelmätilastoja",
@@ -100,6 +82,12 @@ old_start_dt= datetime.datetime(2018, 1, 1, 0, 0, 0)
 
 
 start_date, end_date, aggregation_selection = get_general_layout(start=old_start_dt)
+if not storage.LOCAL_ONLY:
+    # Refresh the stored series before reading their rollups
+    update_wind_corr_data(old_start_dt, end_date)
+    update_temperature_data(old_start_dt, end_date)
+    update_finnish_price_data(start_date, end_date)
+show_data_freshness(['wind_corr', 'temperatures', 'price_FI'])
 
 tab1, tab2, tab3, tab4 = st.tabs(['Tuulivoiman ja lämpötilan korrelaatio',
                                   'Tuulivoiman, lämpötilan ja sähkön hinnan korrelaatio',
@@ -131,14 +119,17 @@ with tab1:
         if st_toggle_switch("Korosta eri vuodet värein?", default_value=True, label_after=True):
             color = 'Vuosi'
 
-        # Then take more recent data to avoid loading too much data every timer
-        df = get_temperatures(old_start_dt, end_date)
-        aggregated_wind = aggregate_data(df, aggregation_selection)
-        aggregated_wind['Vuosi'] = aggregated_wind.index.year.astype(str)
-        with chart_container(aggregated_wind, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
-            fig = px.scatter(aggregated_wind, x='Keskilämpötila', y='Käyttöaste', color=color, trendline="lowess",
-                             trendline_scope="overall", opacity=0.5, height=700,
-                             hover_name=aggregated_wind.index.strftime("%d/%m/%Y %H:%M"), hover_data=['Tuulituotanto', 'Kapasiteetti'])
+        aggregated_wind = get_aggregated_data(old_start_dt, end_date, aggregation_selection)
+        with chart_container(aggregated_wind, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='wind_temperature'):
+            fig = px.scatter(aggregated_wind, x='Keskilämpötila', y='Käyttöaste',
+                             color=calendar_field(aggregated_wind.index, color) if color else None, opacity=0.5,
+                             height=700, hover_name=aggregated_wind.index.strftime("%d/%m/%Y %H:%M"),
+                             hover_data=['Tuulituotanto', 'Kapasiteetti'])
+            trend = get_trendline(old_start_dt, end_date, aggregation_selection,
+                                  (storage.updated_at('wind_corr'), storage.updated_at('temperatures')))
+            fig.add_trace(go.Scatter(x=trend['Keskilämpötila'], y=trend['Käyttöaste'], mode='lines',
+                                     line_color=px.colors.qualitative.Plotly[len(fig.data) % 10],
+                                     hovertemplate='x=%{x:.1f}<br>y=%{y:.1f} <b>(trend)</b><extra></extra>'))
 
             fig.update_layout(dict(yaxis_title='%', xaxis_autorange=True, yaxis_range=[-2, 102],
                                    xaxis_title='Lämpötila', yaxis_tickformat=".2r", yaxis_hoverformat=".1f"))
@@ -151,14 +142,7 @@ with tab1:
 with tab2:
 
     st.header("Tuulen, lämpötilan ja sähkön hinnan korrelaatio")
-    price_df = get_finnish_price_data(start_date, end_date + datetime.timedelta(days=1))
-
-    df.index = df.index.tz_localize(None)
-    price_df.index = pd.to_datetime(price_df.index, utc=True).tz_localize(None)
-    df = pd.merge_asof(df, price_df, left_index=True, right_index=True)
-    df = df.rename({'FI': 'Hinta'}, axis=1)
-    temp_price = aggregate_data(df, aggregation_selection)
-    temp_price['Vuosi'] = temp_price.index.year.astype(str)
+    temp_price = get_aggregated_data(start_date, end_date, aggregation_selection, with_price=True)
 
 
     st.markdown("Tuulivoimatuotannon valitun aggregointitason mukaisen käyttöasteen "
@@ -176,7 +160,8 @@ with tab2:
     range_of_price3d = st.slider("Valitse hintarajat kuvaajalle:", value=(0, 100), min_value=-500, max_value=3000,
                               step=10)
 
-    fig = px.scatter_3d(temp_price, x='Keskilämpötila', y='Hinta', z='Käyttöaste', color=color, opacity=0.3,
+    fig = px.scatter_3d(temp_price, x='Keskilämpötila', y='Hinta', z='Käyttöaste',
+                        color=calendar_field(temp_price.index, color) if color else None, opacity=0.3,
                         height=1000, range_y=range_of_price3d, hover_name=temp_price.index.strftime("%d/%m/%Y %H:%M"))
 
     # fig.update_layout(dict(yaxis_title='Hinta €/MWh', xaxis_autorange=True,
@@ -191,51 +176,20 @@ with tab3:
     st.header("Tuulivoiman lämpökartta vuorokauden tunneilla")
     st.markdown("Lämpökartta kuvaa valitun aikaikkunan sisällä laskettua keskimääräistä tuulivoiman käyttöastetta.")
 
-    df['Tunti'] = df.index.hour.astype(str)
-    df['Päivä'] = df.index.date.astype(str)
-
     range_of_prod = st.slider("Valitse käyttöasterajat kuvaajalle:", value=(0, 100), min_value=0, max_value=100,
                                step=5)
-    fig = px.density_heatmap(df, z='Käyttöaste', y='Tunti', x='Päivä', histfunc='avg',height=600,
-                             color_continuous_scale=px.colors.diverging.balance, range_color=list(range_of_prod))
-
-
-    if aggregation_selection == 'Viikko':
-        agg = 604800000
-    elif aggregation_selection == 'Kuukausi':
-        agg = 'M1'
-    else:
-        agg = 'D1'
-    fig.update_traces(xbins_size=agg)
-    fig.update_layout(dict(xaxis_autorange=True, legend_title="Aikasarja", xaxis_title='Aika'))
-    fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
-    fig.layout['coloraxis']['colorbar']['title']['text'] = 'Käyttöaste %'
-    fig.data[0]['hovertemplate'] = 'Päivä=%{x}<br>Tunti=%{y}<br>Käyttöaste=%{z:.1f}%<extra></extra>'
-    st.plotly_chart(fig, use_container_width=True)
+    grid = get_heatmap_grid('wind_corr', 'Käyttöaste', start_date, end_date, aggregation_selection,
+                            storage.updated_at('wind_corr'))
+    plot_heatmap(grid, 'Käyttöaste', range_of_prod, '%')
 
 with tab4:
     st.header("Sähkön hinnan lämpökartta vuorokauden tunneilla")
     st.markdown("Lämpökartta kuvaa valitun aikaikkunan sisällä laskettua keskimääräistä sähkön hintaa.")
 
-    price_df.index = pd.to_datetime(price_df.index, utc=True)
-    price_df = pd.DataFrame(price_df)
-    price_df['Tunti'] = price_df.index.hour.astype(str)
-    price_df['Päivä'] = price_df.index.date.astype(str)
-    price_df.rename({'FI': 'Hinta'}, axis=1, inplace=True)
     range_of_price = st.slider("Valitse hintarajat kuvaajalle:", value=(0, 200), min_value=-100, max_value=500,
                                step=10)
-    fig = px.density_heatmap(price_df, z='Hinta', y='Tunti', x='Päivä', histfunc='avg', height=600,
-                             range_color=list(range_of_price), color_continuous_scale=px.colors.diverging.balance)
+    grid = get_heatmap_grid('price_FI', 'FI', start_date, end_date, aggregation_selection,
+                            storage.updated_at('price_FI'))
+    plot_heatmap(grid, 'Hinta', range_of_price)
 
-    if aggregation_selection == 'Viikko':
-        agg = 604800000
-    elif aggregation_selection == 'Kuukausi':
-        agg = 'M1'
-    else:
-        agg = 'D1'
-    fig.update_traces(xbins_size=agg)
-    fig.update_layout(dict(xaxis_autorange=True, legend_title="Aikasarja", xaxis_title='Aika'))
-    fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
-    fig.layout['coloraxis']['colorbar']['title']['text'] = 'Hinta'
-    fig.data[0]['hovertemplate'] = 'Päivä=%{x}<br>Tunti=%{y}<br>Hinta=%{z:.1f}<extra></extra>'
-    st.plotly_chart(fig, use_container_width=True)
\ No newline at end of file
+metrics.show_debug_panel()
@@ -1,11 +1,13 @@
 import pandas as pd
+import requests
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objs as go
 import plotly
-from streamlit_extras.chart_container import chart_container
-from src.fingridapi import get_data_from_fg_api_with_start_end, search_fg_api
+from src.datahub import get_dataset_df
 from src.general_functions import get_general_layout, aggregate_data, sidebar_contact_info
+from src.charts import chart_container, downsample, zoom
+from src import catalogue, metrics
 from datetime import datetime, time, timedelta, date
 
 st.set_page_config(
@@ -16,22 +18,17 @@ st.set_page_config(
 )
 
 
-@st.cache_data(show_spinner=False)
-def convert_df_to_csv(df):
-    return df.to_csv().encode("utf-8")
-
-
-@st.cache_data(show_spinner=False, max_entries=200)
 def get_data_df(start, end, id, nimi):
     """
-    Get the production and  demand values from Fingrid API between the start and end dates
+    Get the values of the selected dataset from Fingrid API between the start and end dates. Datasets are cached by
+    month in src/datahub.py.
     :param start: start date
     :param end: end date
-    :return: production dataframe with demand values included
+    :param id: dataset id
+    :param nimi: name of the dataset
+    :return: dataframe with the values named by the dataset, Datahub datasets with one column per customer group
     """
-    df = get_data_from_fg_api_with_start_end(id, start, end)
-    df.rename({'Value': nimi}, axis=1, inplace=True)
-    return df
+    return get_dataset_df(id, start, end).rename({'Value': nimi}, axis=1)
 
 
 def click_button():
@@ -42,49 +39,14 @@ def search_button_click():
     st.session_state.search = True
 
 
-@st.cache_data(show_spinner=False, max_entries=200)
 def search_data_df(search_key, api_key):
-    search_df = search_fg_api(search_key, api_key)
+    # Searched from the local catalogue, the API key is only needed if the catalogue has not been downloaded yet
+    search_df = catalogue.search(search_key, api_key)
     search_df = search_df[['nameFi', 'id', 'dataPeriodFi', 'unitFi', 'searchScore', 'descriptionFi']]
     search_df.insert(0, 'search', False)
     return search_df
 
-datahub_mapping = {
-    'BE01': 'Asunnot, kerrostalo',
-    'BE02': 'Asunnot, pientalo (rivi-, pari- ja omakotitalo), sähkölämmitteinen',
-    'BE03': 'Asunnot, pientalo (rivi-, pari- ja omakotitalo), ei-sähkölämmitteinen',
-    'BE04': 'Asunnot, vapaa-ajan asunto',
-    'BE05': 'Asuinkiinteistöt',
-    'BE06': 'Maataloustuotanto (TOL A)',
-    'BE07': 'Teollisuus (TOL B ja C)',
-    'BE08': 'Yhdyskuntahuolto tai energia- ja vesihuolto (TOL D, E)',
-    'BE09': 'Rakentaminen (tilapäissähkö) (TOL F)',
-    'BE10': 'Palvelut',
-    'BE11': 'Ulkovalaistus',
-    'BE12': 'Sähköautojen latauspisteet',
-    'BE13': 'Liikenne',
-    'BE14': 'Muu kohde',
-    'AB01': 'Yritys',
-    'AB02': 'Kuluttaja',
-    'AV01': 'Vesivoima',
-    'AV02': 'Tuulivoima',
-    'AV03': 'Ydinvoima',
-    'AV04': 'Kaasuturbiini',
-    'AV05': 'Diesel-voimakone',
-    'AV06': 'Aurinkovoima',
-    'AV07': 'Aaltovoima',
-    'AV08': 'Yhteistuotanto',
-    'AV09': 'Biovoima',
-    'AV10': 'Muu tuotanto',
-    '0': '0-2000 kWh',
-    '2k': '2000-20 000 kWh',
-    '20k': '20 000-100 000 kWh',
-    '100k': 'yli 100 000 kWh',
-    'E13': 'Jatkuva mittaus',
-    'E14': 'Lukemamittaus',
-    'E16': 'Mittaroimaton'
-}
-
+metrics.start_run()
 st.image('./src/EnergiaDashboard.png', width=1000)
 with st.sidebar:
     sidebar_contact_info()
@@ -99,6 +61,7 @@ if 'fetced' not in st.session_state:
 st.header('Fingridin avoimen datan vapaa haku')
 st.write("Työkalun avulla voit hakea itse vapaasti mitä tahansa tietolähdettä Fingridin avoimesta datasta.")
 
+# Datasets are searched from a local copy of the catalogue, the key is needed only if it has not been downloaded yet
 api_key = st.text_input("Anna oma API-avaimesi hakua varten:")
 st.markdown(
     "API-avaimen voit hankkia rekisteröitymällä / kirjautumalla [data.fingrid.fi](https://data.fingrid.fi/instructions)  \n"
@@ -107,17 +70,22 @@ st.markdown(
 with st.expander("Tietolähteiden haku ja valinta"):
     search_key = st.text_input("Anna hakuavain, mitä tietolähdettä etsit:")
     button = st.button("Hae", on_click=click_button)
-    if st.session_state.clicked and api_key:
+    if st.session_state.clicked and (api_key or catalogue.available()):
         try:
             search_df = search_data_df(search_key, api_key)
-            search_score_max = search_df['searchScore'].max()
+            if search_df.empty:
+                st.warning("Hakuavaimella ei löytynyt tietolähteitä.")
+                st.session_state.clicked = False
+            else:
+                search_score_max = float(search_df['searchScore'].max())
 
-        except KeyError as e:
+        except (KeyError, requests.RequestException):
             st.error("Haussa tapahtui virhe, tuloksia ei mahdollisesti löytynyt, voit myös "
                      "yrittää uudestaan tai tarkista API-avain.")
             st.session_state.clicked = False
-    elif not api_key:
+    elif not api_key and not catalogue.available():
         st.warning("Aseta API-avain")
+        st.session_state.clicked = False
 
     if st.session_state.clicked:
         end = datetime.now()
@@ -174,21 +142,11 @@ if st.session_state.search:
                 st.toast(f'Datahaku {data_name} mittausväli on 3 min ja sen haku voi kestää pidempään')
             data = get_data_df(start_date, end_date, data_id, data_name)
 
-            # Handle Datahub data
-            if len(data.columns) > 1:
-                cols = list(data.columns[1:])
-                data = pd.pivot_table(data=data, index=data.index, columns=cols, values=data_name)
-                # Flatten multi-index columns
-                if isinstance(data.columns, pd.MultiIndex):
-                    data.columns = [(datahub_mapping[col[0]], datahub_mapping[col[1]]) for col in data.columns]
-                    data.columns = [' - '.join(col).strip() for col in data.columns]
-                else:
-                    data.columns = [datahub_mapping[col] for col in data.columns]
-
-            else:
+            # Datahub data is already split into columns by customer groups, other datasets can be combined
+            if len(data.columns) == 1:
                 df_list.append(data)
-            with chart_container(data, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
-                fig = px.line(data)
+            with chart_container(data, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key=f'data_{data_id}'):
+                fig = px.line(downsample(zoom(data, f'zoom_{data_id}')))
                 fig.update_traces(line=dict(width=2.5))
                 fig.update_layout(dict(yaxis_title=data_unit, legend_title="Aikasarja", yaxis_tickformat=".2r",
                                        yaxis_hoverformat=".1f"))
@@ -202,9 +160,11 @@ if st.session_state.fetched and len(df_list) > 1:
 
         all_data = pd.concat(df_list, axis=1)
         all_data = aggregate_data(all_data, aggregation_selection, 'ffill')
-        with chart_container(all_data, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], ["CSV"]):
-            fig = px.line(all_data)
+        with chart_container(all_data, ["Kuvaaja 📈", "Data 📄", "Lataa 📁"], key='all'):
+            fig = px.line(downsample(zoom(all_data, 'zoom_all')))
             fig.update_traces(line=dict(width=2.5))
             fig.update_layout(dict(yaxis_title="", legend_title="Aikasarja", yaxis_tickformat=".2r",
                                    yaxis_hoverformat=".1f"))
             st.plotly_chart(fig, use_container_width=True)
+
+metrics.show_debug_panel()
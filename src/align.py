@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+Alignment of time series by timestamp on a canonical UTC grid. Every slot of the grid is identified by an integer,
+the UTC nanoseconds of its start divided by the step, so series are joined by integer slot numbers instead of
+comparing or converting timestamps, and DST changes or gaps in either series can't shift the values. Series are
+converted to Finnish time only when they are shown.
+"""
+
+# Grid frequency -> step in nanoseconds
+STEPS = {'H': 3600 * 10 ** 9, '15min': 900 * 10 ** 9, '3min': 180 * 10 ** 9}
+
+
+def _utc_nanoseconds(index):
+    # Nanoseconds of a tz-aware index are UTC, so they are used as is. Naive timestamps are interpreted as UTC.
+    return index.asi8
+
+
+def infer_step(index):
+    """
+    :param index: datetime index
+    :return: most common step between the timestamps in nanoseconds, one hour if it can't be inferred
+    """
+    differences = np.diff(_utc_nanoseconds(index))
+    differences = differences[differences > 0]
+    if len(differences) == 0:
+        return STEPS['H']
+    steps, counts = np.unique(differences, return_counts=True)
+    return int(steps[np.argmax(counts)])
+
+
+def _values_at(values, first, step, index):
+    positions = _utc_nanoseconds(index) // step - first
+    inside = (positions >= 0) & (positions < len(values))
+    result = np.full(len(positions), np.nan)
+    result[inside] = values[positions[inside]]
+    return result
+
+
+def _grid_steps(index):
+    """
+    :param index: datetime index
+    :return: tuple of the finest and the coarsest of the STEPS between the timestamps, e.g. 15 minutes and an hour for
+    prices that changed from hourly to 15 minute resolution, or the most common step twice if none of them occur
+    """
+    differences = set(np.diff(_utc_nanoseconds(index)).tolist())
+    steps = [step for step in STEPS.values() if step in differences]
+    if not steps:
+        step = infer_step(index)
+        return step, step
+    return min(steps), max(steps)
+
+
+class GridSeries:
+    """
+    Series stored on the UTC grid as a contiguous array of values from its first to its last slot. A series whose
+    resolution changes is stored on the grid of its finest step, and each value fills the slots until the next value,
+    at most its coarsest step, e.g. an hourly value fills the four 15 minute slots of its hour. Empty slots are NaN.
+    The alignment report counts the slots without a value, the slots with several values (the last one is kept) and
+    the timestamps between slots.
+    """
+
+    def __init__(self, series, freq=None):
+        """
+        :param series: series with a datetime index
+        :param freq: grid frequency, one of STEPS, inferred from the series if None
+        """
+        self.name = series.name
+        self.step, coarsest = (STEPS[freq],) * 2 if freq is not None else _grid_steps(series.index)
+        span = coarsest // self.step
+        nanoseconds = _utc_nanoseconds(series.index)
+        slots = nanoseconds // self.step
+        values = series.to_numpy(dtype=np.float64)
+        if len(slots) and (np.diff(slots) < 0).any():
+            order = np.argsort(slots, kind='stable')
+            slots, values = slots[order], values[order]
+        self.first = int(slots[0]) if len(slots) else 0
+        positions = slots - self.first
+        # Slots are sorted, so the last value of each slot is the one before the next slot starts
+        last = np.append(positions[1:] != positions[:-1], len(positions) > 0)[:len(positions)]
+        filled = positions[last]
+        # Each value fills the slots until the next value, but at most the span of the coarsest step. The last value
+        # fills as many slots as the value before it.
+        gaps = np.diff(filled)
+        lengths = np.minimum(np.append(gaps, gaps[-1] if len(gaps) else span)[:len(filled)], span)
+        self.values = np.full(int(filled[-1] + lengths[-1]) if len(filled) else 0, np.nan)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        self.values[np.repeat(filled, lengths) + offsets] = np.repeat(values[last], lengths)
+        counts = np.bincount(positions, minlength=len(self.values))
+        self.report = {'missing': int(len(self.values) - lengths.sum()), 'duplicated': int((counts > 1).sum()),
+                       'off_grid': int((nanoseconds % self.step != 0).sum())}
+
+    def at(self, index):
+        """
+        Values of the slots the timestamps fall into
+        :param index: datetime index
+        :return: array of values aligned with the index, NaN for timestamps outside the series or in empty slots
+        """
+        return _values_at(self.values, self.first, self.step, index)
+
+    def mean_at(self, index, step):
+        """
+        Means of the values over the slots of a longer step the timestamps fall into, e.g. the hourly mean of a 15
+        minute series
+        :param index: datetime index
+        :param step: step of the longer slots in nanoseconds, a multiple of the step of the series
+        :return: array of means aligned with the index, NaN for timestamps outside the series or in slots without values
+        """
+        if not len(self.values):
+            return np.full(len(index), np.nan)
+        starts = (self.first + np.arange(len(self.values), dtype=np.int64)) * self.step
+        positions = starts // step - starts[0] // step
+        valid = ~np.isnan(self.values)
+        sums = np.bincount(positions[valid], weights=self.values[valid], minlength=int(positions[-1]) + 1)
+        counts = np.bincount(positions[valid], minlength=int(positions[-1]) + 1)
+        means = np.divide(sums, counts, out=np.full(len(sums), np.nan), where=counts > 0)
+        return _values_at(means, int(starts[0] // step), step, index)
+
+    def to_series(self, tz='Europe/Helsinki'):
+        """
+        :param tz: time zone of the returned index
+        :return: series of every slot, indexed by the slot starts
+        """
+        starts = (self.first + np.arange(len(self.values), dtype=np.int64)) * self.step
+        return pd.Series(self.values, index=pd.to_datetime(starts, utc=True).tz_convert(tz), name=self.name)
+
+
+def align(series, index, freq=None):
+    """
+    Align the series to the timestamps of another series by their slots on the UTC grid of the series, e.g. an hourly
+    price to every 15 minutes of a production series. A series finer than the index is averaged over each step of the
+    index, e.g. 15 minute prices joined to hourly production give the mean price of the hour.
+    :param series: series with a datetime index
+    :param index: datetime index to align to
+    :param freq: grid frequency of the series, one of STEPS, inferred if None
+    :return: tuple of the aligned series sharing the index and the alignment report of the series at its own
+    resolution, with 'unmatched' counting the timestamps of the index without a value
+    """
+    grid = GridSeries(series, freq)
+    step = infer_step(index)
+    values = grid.mean_at(index, step) if step > grid.step and step % grid.step == 0 else grid.at(index)
+    report = dict(grid.report, unmatched=int(np.isnan(values).sum()))
+    return pd.Series(values, index=index, name=series.name), report
+
+
+def describe(report):
+    """
+    :param report: alignment report from align
+    :return: description of the missing and duplicated values shown on the pages, None if every timestamp matched
+    """
+    problems = []
+    if report['unmatched']:
+        problems.append(f"{report['unmatched']} ajankohdalta puuttuu arvo")
+    if report['duplicated']:
+        problems.append(f"{report['duplicated']} ajankohdalla on useampi arvo, joista käytetään viimeistä")
+    return ', '.join(problems).capitalize() + '.' if problems else None
@@ -0,0 +1,277 @@
+import contextlib
+import copy
+import datetime
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+import streamlit as st
+from src import dtypes, memory_cache, metrics, storage
+from src.singleflight import SingleFlight
+
+
+"""
+Caching of the data loaders. Values are cached in memory in a cache shared by all loaders and limited by the total
+size of the values (src/memory_cache.py). Lookups are counted as cache hits and misses per function and calls are
+timed, so the debug panel and the metrics file show which loaders are served from the cache. Returned frames are
+converted to compact dtypes before they are cached, and the memory saved is recorded per function.
+
+Loaders of a date range are cached in two tiers (tiered_cache_data). Days older than the settlement horizon of the
+dataset no longer change, so they are cached without expiry, while the recent days are cached only for a short time.
+"""
+
+# Seconds the recent, still changing days are cached, i.e. the longest delay of new data showing on the pages
+RECENT_TTL = 300
+
+_flight = SingleFlight('cache')
+
+
+def _argument_key(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = (list(value.columns), value.dtypes.astype(str).tolist()) if isinstance(value, pd.DataFrame) \
+            else (value.name, str(value.dtype))
+        digest = hashlib.sha1(pickle.dumps(labels))
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        return type(value).__name__, digest.hexdigest()
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        # Lists and dictionaries, e.g. selected areas, are identified by their contents
+        return hashlib.sha1(pickle.dumps(value)).hexdigest()
+
+
+def _size(value, seen=None):
+    """
+    Size of the value in bytes including everything it refers to, objects referred to several times are counted once.
+    Values that can't be measured are counted as infinitely large, so they are rejected by the cache.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return dtypes.memory_usage(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.dtype != object else sys.getsizeof(value) + sum(
+            _size(item, seen) for item in value.ravel())
+    if isinstance(value, (str, bytes, int, float, complex, type(None), datetime.date, datetime.timedelta)):
+        return sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return sys.getsizeof(value) + sum(_size(item, seen) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_size(key, seen) + _size(item, seen) for key, item in value.items())
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + _size(vars(value), seen)
+    try:
+        # Other objects, e.g. models of extension libraries, are measured by their serialized size
+        return len(pickle.dumps(value))
+    except Exception:
+        return float('inf')
+
+
+def _copy(value):
+    # Callers get their own copy, so modifying a returned frame never changes the cached one
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=True)
+    return copy.deepcopy(value)
+
+
+def _function_name(filename, qualname):
+    """
+    :return: name of a cached function in the statistics, its file relative to the working directory and its name
+    """
+    try:
+        filename = os.path.relpath(filename)
+    except ValueError:
+        # On Windows files on another drive have no relative path
+        pass
+    return f'{filename}:{qualname}'
+
+
+def cache_data(ttl=None, max_entries=None, show_spinner=False):
+    """
+    Cache the values returned by the decorated function in the shared byte-budgeted cache (src/memory_cache.py),
+    counting the hits and misses of the function. Returned frames are cached with compact dtypes and every call gets a
+    copy of the cached value. Concurrent calls with the same arguments compute the value only once. Callers loading
+    several values in one batch can look them up and cache them with get_cached and set_cached of the decorated
+    function.
+    :param ttl: seconds (or timedelta) the values are cached, no expiry if None
+    :param max_entries: maximum number of values cached for the function, only limited by the byte budget if None
+    :param show_spinner: show a spinner while the value is computed, True or the text shown
+    """
+    if isinstance(ttl, datetime.timedelta):
+        ttl = ttl.total_seconds()
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        # Pages are run again on every rerun, so the functions are identified by their file and name instead of the
+        # function objects. Functions of different files may share a name, so the statistics use the same identity.
+        namespace = (inspect.unwrap(fn).__code__.co_filename, fn.__qualname__)
+        name = _function_name(*namespace)
+
+        def key_of(args, fn_kwargs):
+            arguments = signature.bind(*args, **fn_kwargs)
+            arguments.apply_defaults()
+            return (namespace, tuple(_argument_key(value) for value in arguments.arguments.values())), arguments
+
+        def compacted(result):
+            if isinstance(result, (pd.DataFrame, pd.Series)):
+                original = dtypes.memory_usage(result)
+                result = dtypes.compact(result)
+                metrics.record_memory(name, original, dtypes.memory_usage(result))
+            return result
+
+        def compute(arguments):
+            spinner = st.spinner(show_spinner if isinstance(show_spinner, str) else f'Ladataan {fn.__name__}...') \
+                if show_spinner else contextlib.nullcontext()
+            with spinner:
+                return compacted(fn(*arguments.args, **arguments.kwargs))
+
+        def load(key, arguments, computed):
+            # Looked up again, the value may have been cached while waiting for the previous computation
+            hit, result = memory_cache.shared.get(key)
+            if not hit:
+                computed.append(key)
+                result = compute(arguments)
+                memory_cache.shared.put(name, key, result, _size(result), ttl, max_entries)
+            return result
+
+        @functools.wraps(fn)
+        def wrapper(*args, **fn_kwargs):
+            with metrics.span(name):
+                key, arguments = key_of(args, fn_kwargs)
+                hit, result = memory_cache.shared.get(key)
+                if not hit:
+                    # Callers waiting for the computation of another caller count as hits
+                    computed = []
+                    result = _flight.do(key, load, key, arguments, computed)
+                    hit = not computed
+                result = _copy(result)
+            metrics.count_cache(name, hit=hit)
+            return result
+
+        def get_cached(*args, **fn_kwargs):
+            """
+            Look up the value of the arguments without computing it, e.g. to load the missing values in one batch
+            :return: tuple of (True, copy of the value) if it is cached, otherwise (False, None)
+            """
+            hit, result = memory_cache.shared.get(key_of(args, fn_kwargs)[0])
+            metrics.count_cache(name, hit=hit)
+            return hit, _copy(result) if hit else None
+
+        def set_cached(value, *args, **fn_kwargs):
+            """
+            Cache a value computed outside the function for the arguments
+            :return: copy of the cached value
+            """
+            value = compacted(value)
+            memory_cache.shared.put(name, key_of(args, fn_kwargs)[0], value, _size(value), ttl, max_entries)
+            return _copy(value)
+
+        wrapper.get_cached = get_cached
+        wrapper.set_cached = set_cached
+        wrapper.clear = lambda: memory_cache.shared.clear(name)
+        return wrapper
+    return decorator
+
+
+def clear():
+    """
+    Remove the cached values of every function
+    """
+    memory_cache.shared.clear()
+
+
+def _tier(fn, tier):
+    # Each tier needs its own name for the cache keys and statistics
+    @functools.wraps(fn)
+    def load(*args, **kwargs):
+        return fn(*args, **kwargs)
+    load.__name__ = f'{fn.__name__}.{tier}'
+    load.__qualname__ = f'{fn.__qualname__}.{tier}'
+    return load
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def settled_until(settlement):
+    """
+    :param settlement: timedelta after which the data of a day no longer changes
+    :return: first day whose data may still change, in Finnish time
+    """
+    return (pd.Timestamp.now(tz='Europe/Helsinki') - settlement).date()
+
+
+def _covers(result, end):
+    # Whether the result reaches the last day of the range, in Finnish time like the ranges
+    if len(result) == 0:
+        return False
+    last = result.index.max()
+    if last.tzinfo is not None:
+        last = last.tz_convert('Europe/Helsinki')
+    return last.date() >= end
+
+
+def tiered_cache_data(settlement, recent_ttl=RECENT_TTL, **kwargs):
+    """
+    Cache a loader of a date range in two tiers. The days before the settlement horizon are cached without expiry and
+    the recent days for recent_ttl seconds, and the result is assembled from both. A range ending today therefore
+    reuses the cached history and only the recent days are reloaded when they expire.
+    When pages only read the local store (storage.LOCAL_ONLY), history that is empty or ends before the end of its
+    range is not cached, so the days the background ingestion hasn't stored yet are read again on the next call.
+    The decorated function takes start and end dates (inclusive) and returns a time indexed dataframe or series.
+    :param settlement: timedelta after which the data of a day no longer changes
+    :param recent_ttl: seconds the recent days are cached
+    :param kwargs: other arguments of cache_data
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        history = cache_data(**kwargs)(_tier(fn, 'history'))
+        recent = cache_data(ttl=recent_ttl, **kwargs)(_tier(fn, 'recent'))
+
+        def load(tier, arguments, start, end):
+            arguments.arguments['start'], arguments.arguments['end'] = start, end
+            return tier(*arguments.args, **arguments.kwargs)
+
+        def load_history(arguments, start, end):
+            if not storage.LOCAL_ONLY:
+                return load(history, arguments, start, end)
+            arguments.arguments['start'], arguments.arguments['end'] = start, end
+            hit, result = history.get_cached(*arguments.args, **arguments.kwargs)
+            if hit:
+                return result
+            result = fn(*arguments.args, **arguments.kwargs)
+            if not _covers(result, end):
+                return result
+            return history.set_cached(result, *arguments.args, **arguments.kwargs)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **fn_kwargs):
+            arguments = signature.bind(*args, **fn_kwargs)
+            start, end = _as_date(arguments.arguments['start']), _as_date(arguments.arguments['end'])
+            split = max(start, settled_until(settlement))
+            parts = []
+            if start < split:
+                parts.append(load_history(arguments, start, min(end, split - datetime.timedelta(days=1))))
+            if end >= split:
+                parts.append(load(recent, arguments, split, end))
+            if len(parts) == 1:
+                return parts[0]
+            result = pd.concat(parts)
+            # Categoricals of the tiers may have different categories, which makes them plain objects again
+            return dtypes.compact(result[~result.index.duplicated(keep='last')])
+
+        def clear():
+            history.clear()
+            recent.clear()
+
+        wrapper.clear = clear
+        return wrapper
+    return decorator
@@ -0,0 +1,177 @@
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import pandas as pd
+from src import fingridapi, metrics, storage
+
+
+"""
+Local snapshot of Fingrid's dataset catalogue with a full-text search index, so the free search page finds datasets
+without a request to the API. The snapshot is stored in the local store and refreshed by the background ingestion
+(src/ingest.py), or by the app itself in a background thread when it is older than MAX_AGE.
+
+Search words are matched to the beginning of the words of the dataset fields, e.g. 'tuul' finds 'Tuulivoima', and
+every word of the search has to match. Datasets are ranked by the fields the words match, names and ids weighing
+more than units and descriptions, and full word matches more than prefixes.
+"""
+
+# Seconds after which the app refreshes the snapshot in the background
+MAX_AGE = 24 * 3600
+CATALOGUE_PAGE_SIZE = 1000
+
+# Field -> weight of a word matching it
+FIELD_WEIGHTS = {'id': 5, 'nameFi': 4, 'nameEn': 3, 'unitFi': 2, 'unitEn': 1, 'dataPeriodFi': 2, 'dataPeriodEn': 1,
+                 'descriptionFi': 1, 'descriptionEn': 1}
+# Full word matches score this many times the weight of the field, prefix matches the weight
+EXACT_MATCH_FACTOR = 2
+
+_WORD = re.compile(r'\w+')
+
+_index = None
+_index_lock = threading.Lock()
+_refresher = None
+
+
+def _path():
+    return os.path.join(storage.STORE_PATH, 'fingrid_catalogue.parquet')
+
+
+def tokenize(text):
+    """
+    :return: lowercase words of the text
+    """
+    return _WORD.findall(str(text).lower())
+
+
+class CatalogueIndex:
+    """
+    Inverted index of the catalogue. Words are kept sorted, so the words starting with a prefix are found with a
+    binary search.
+    """
+
+    def __init__(self, datasets):
+        """
+        :param datasets: dataframe with one row per dataset and the FIELD_WEIGHTS columns
+        """
+        self.datasets = datasets.reset_index(drop=True)
+        # Word -> {row: weight of the best field containing the word}
+        postings = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            if field not in self.datasets.columns:
+                continue
+            for row, text in enumerate(self.datasets[field].fillna('')):
+                for word in tokenize(text):
+                    rows = postings.setdefault(word, {})
+                    rows[row] = max(rows.get(row, 0), weight)
+        self._postings = postings
+        self._words = sorted(postings)
+
+    def _matches(self, prefix):
+        scores = {}
+        for position in range(bisect.bisect_left(self._words, prefix), len(self._words)):
+            word = self._words[position]
+            if not word.startswith(prefix):
+                break
+            factor = EXACT_MATCH_FACTOR if word == prefix else 1
+            for row, weight in self._postings[word].items():
+                scores[row] = max(scores.get(row, 0), weight * factor)
+        return scores
+
+    def search(self, query, limit=None):
+        """
+        :param query: search words
+        :param limit: maximum number of datasets returned, all matches if None
+        :return: matching datasets with their score in the searchScore column, best matches first
+        """
+        scores = None
+        for word in tokenize(query):
+            matches = self._matches(word)
+            scores = matches if scores is None else {row: score + matches[row]
+                                                     for row, score in scores.items() if row in matches}
+        if scores is None:
+            # Without search words the whole catalogue is listed
+            scores = dict.fromkeys(range(len(self.datasets)), 0)
+        result = self.datasets.iloc[list(scores)].assign(searchScore=list(scores.values()))
+        result = result.sort_values(['searchScore', 'id'], ascending=[False, True], kind='stable')
+        return result.head(limit) if limit is not None else result
+
+
+@metrics.timed('catalogue.refresh')
+def refresh(apikey=None):
+    """
+    Download the dataset catalogue from the API and store it as the local snapshot
+    :param apikey: API key, FGAPIKEY by default
+    :return: number of datasets
+    """
+    headers = {'x-api-key': apikey or os.environ.get('FGAPIKEY')}
+    datasets, page, last_page = [], 1, 1
+    while page <= last_page:
+        res = fingridapi.request(f'{fingridapi.FG_API_URL}/datasets?page={page}&pageSize={CATALOGUE_PAGE_SIZE}&'
+                                  f'orderBy=id', headers)
+        response = json.loads(res.content)
+        datasets.extend(response['data'])
+        last_page = response.get('pagination', {}).get('lastPage', 1)
+        page += 1
+    df = pd.DataFrame(datasets).reindex(columns=list(FIELD_WEIGHTS))
+    df['id'] = df['id'].astype(int)
+    df = df.fillna('').sort_values('id')
+    with storage.locked('fingrid_catalogue'):
+        storage.write_atomic(_path(), df.reset_index(drop=True))
+    return len(df)
+
+
+def _refresh_in_background(apikey):
+    global _refresher
+    with _index_lock:
+        if _refresher is not None and _refresher.is_alive():
+            return
+
+        def run():
+            try:
+                refresh(apikey)
+            except Exception as e:
+                print(f'Refreshing the Fingrid catalogue failed: {e}')
+
+        _refresher = threading.Thread(target=run, name='catalogue-refresh', daemon=True)
+        _refresher.start()
+
+
+def available():
+    """
+    :return: True if the catalogue snapshot is stored
+    """
+    return os.path.exists(_path())
+
+
+def get_index(apikey=None):
+    """
+    Index of the stored snapshot, read again when the snapshot has been refreshed. Without a snapshot the catalogue
+    is downloaded first. A snapshot older than MAX_AGE is used as is and refreshed in the background.
+    :param apikey: API key used when the catalogue is downloaded, FGAPIKEY by default
+    :return: CatalogueIndex
+    """
+    global _index
+    if not available():
+        refresh(apikey)
+    modified = os.path.getmtime(_path())
+    if time.time() - modified > MAX_AGE and not storage.LOCAL_ONLY and (apikey or os.environ.get('FGAPIKEY')):
+        _refresh_in_background(apikey)
+    with _index_lock:
+        if _index is None or _index[0] != modified:
+            _index = (modified, CatalogueIndex(pd.read_parquet(_path())))
+        return _index[1]
+
+
+@metrics.timed('catalogue.search')
+def search(query, apikey=None, limit=None):
+    """
+    Search the datasets of the catalogue
+    :param query: search words, matched to the beginning of the words of the dataset fields
+    :param apikey: API key used if the catalogue has to be downloaded
+    :param limit: maximum number of datasets returned
+    :return: dataframe of the matching datasets with a searchScore column, best matches first
+    """
+    return get_index(apikey).search(query, limit)
@@ -0,0 +1,221 @@
+import contextlib
+import hashlib
+import io
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+from src import metrics
+
+
+"""
+Helpers for keeping the amount of data sent to plotly charts proportional to the chart size instead of the length
+of the selected time range, and the chart container with tabs for the data and its download.
+"""
+
+# Width of the charts in pixels with the wide page layout and the number of points drawn per pixel
+CHART_WIDTH = 1200
+POINTS_PER_PIXEL = 2
+
+# Export format -> file extension and MIME type
+EXPORT_FORMATS = {'CSV': ('.csv', 'text/csv'),
+                  'Parquet': ('.parquet', 'application/vnd.apache.parquet'),
+                  'Arrow': ('.arrow', 'application/vnd.apache.arrow.file')}
+
+
+def point_budget(width=CHART_WIDTH, points_per_pixel=POINTS_PER_PIXEL):
+    """
+    Maximum number of points per trace that can be shown on a chart of the given width
+    :param width: chart width in pixels
+    :param points_per_pixel: points drawn per pixel
+    :return: number of points
+    """
+    return int(width * points_per_pixel)
+
+
+def _x_values(index):
+    if isinstance(index, pd.DatetimeIndex):
+        return index.asi8.astype(np.float64)
+    return np.arange(len(index), dtype=np.float64)
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Select points with the Largest-Triangle-Three-Buckets algorithm, which keeps the visual shape of the series
+    :param x: x values as floats
+    :param y: y values as floats
+    :param n_out: number of points to select
+    :return: sorted positions of the selected points
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+    # First and last points are always kept, the rest are split into equally sized buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        # Average of the next bucket is used as the third point of the triangle
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean() if next_end > end else x[n - 1]
+        next_y = y[end:next_end].mean() if next_end > end else y[n - 1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def minmax_indices(y, n_out):
+    """
+    Select the minimum and maximum point of equally sized buckets, which keeps every peak of the series
+    :param y: y values as floats
+    :param n_out: number of points to select
+    :return: sorted positions of the selected points
+    """
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    y = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(np.int64)
+    selected = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            selected.append(start + int(np.argmin(y[start:end])))
+            selected.append(start + int(np.argmax(y[start:end])))
+    return np.unique(selected)
+
+
+@metrics.timed('chart.downsample')
+def downsample(df, n_out=None, method='lttb'):
+    """
+    Reduce the rows of the dataframe for plotting. Points are selected for each numeric column separately and the
+    union of them is returned, so all traces still share the same x values (needed e.g. for stacked area charts).
+    :param df: dataframe with a datetime index
+    :param n_out: maximum number of rows, defaults to the point budget of a full width chart
+    :param method: 'lttb' or 'minmax'
+    :return: dataframe with at most n_out rows
+    """
+    if n_out is None:
+        n_out = point_budget()
+    columns = df.select_dtypes('number').columns
+    if len(df) <= n_out or len(columns) == 0:
+        return df
+    per_column = max(3, n_out // len(columns))
+    x = _x_values(df.index)
+    selected = []
+    for column in columns:
+        y = df[column].to_numpy(dtype=np.float64)
+        if method == 'minmax':
+            selected.append(minmax_indices(y, per_column))
+        else:
+            selected.append(lttb_indices(x, y, per_column))
+    return df.iloc[np.unique(np.concatenate(selected))]
+
+
+def zoom(df, key):
+    """
+    Show a range slider when the data has more points than a chart can show. Data of the selected range is returned
+    at full resolution, so narrowing the range shows more detail after downsampling.
+    :param df: dataframe with a datetime index
+    :param key: unique key for the slider
+    :return: dataframe filtered to the selected range
+    """
+    if len(df) <= point_budget() or not isinstance(df.index, pd.DatetimeIndex):
+        return df
+    # Slider works with naive datetimes, so compare using Finnish wall clock time
+    local_index = df.index.tz_localize(None) if df.index.tz is not None else df.index
+    first, last = local_index.min().to_pydatetime(), local_index.max().to_pydatetime()
+    selected = st.slider("Tarkenna aikaväliä", min_value=first, max_value=last, value=(first, last),
+                         format="DD.MM.YYYY HH:mm", key=key)
+    return df[(local_index >= selected[0]) & (local_index <= selected[1])]
+
+
+@metrics.timed('chart.hour_grid')
+def hour_grid(series, aggregation_selection):
+    """
+    Average the series by hour of day and by day, week or month, so a heatmap only needs one cell per hour and period
+    instead of every observation
+    :param series: series with a datetime index in local time
+    :param aggregation_selection: aggregation level, weeks and months are used as periods on those levels and days
+    otherwise
+    :return: dataframe with hours of day (0-23) as rows and period starts as columns
+    """
+    local_index = series.index.tz_localize(None) if series.index.tz is not None else series.index
+    if aggregation_selection == 'Viikko':
+        periods = (local_index - pd.to_timedelta(local_index.dayofweek, unit='D')).normalize()
+    elif aggregation_selection == 'Kuukausi':
+        periods = local_index.to_period('M').to_timestamp()
+    else:
+        periods = local_index.normalize()
+    codes, labels = pd.factorize(periods, sort=True)
+    values = series.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+    cells = local_index.hour.to_numpy() * len(labels) + codes
+    sums = np.bincount(cells[valid], weights=values[valid], minlength=24 * len(labels))
+    counts = np.bincount(cells[valid], minlength=24 * len(labels))
+    means = np.divide(sums, counts, out=np.full(len(sums), np.nan), where=counts > 0)
+    return pd.DataFrame(means.reshape(24, len(labels)), index=pd.RangeIndex(24, name='Tunti'),
+                        columns=pd.DatetimeIndex(labels, name='Aika'))
+
+
+def export_file(data, export_format):
+    """
+    Convert the dataframe to a file, written straight into a single buffer
+    :param data: dataframe
+    :param export_format: one of EXPORT_FORMATS
+    :return: bytes of the file
+    """
+    file = io.BytesIO()
+    if export_format == 'CSV':
+        data.to_csv(file, encoding='utf-8')
+    elif export_format == 'Parquet':
+        data.to_parquet(file, compression='zstd')
+    elif export_format == 'Arrow':
+        table = pa.Table.from_pandas(data, preserve_index=True)
+        with pa.ipc.new_file(file, table.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f'Unknown export format {export_format}, expected one of {", ".join(EXPORT_FORMATS)}')
+    return file.getvalue()
+
+
+def _export_key(data):
+    # Widget keys must stay the same over reruns, so they are derived from the shape of the data without reading it
+    bounds = (data.index[0], data.index[-1]) if len(data) else ()
+    return hashlib.sha1(repr((list(map(str, data.columns)), len(data), bounds)).encode()).hexdigest()[:12]
+
+
+@contextlib.contextmanager
+def chart_container(data, tabs=('Kuvaaja 📈', 'Data 📄', 'Lataa 📁'), export_formats=tuple(EXPORT_FORMATS),
+                    key=None):
+    """
+    Tabs for the chart built inside the container, the data and its download. Building the chart is timed as a chart
+    span. Download files are only created when the user asks for them, so the download tab costs nothing on reruns.
+    :param data: dataframe shown and downloadable in the other tabs
+    :param tabs: labels of the chart, data and download tabs
+    :param export_formats: downloadable formats, keys of EXPORT_FORMATS
+    :param key: unique key of the download buttons, derived from the columns, length and first and last timestamps
+        of the data if None
+    """
+    key = key or _export_key(data)
+    chart_tab, data_tab, export_tab = st.tabs(tabs)
+    with chart_tab:
+        with metrics.span('chart', ', '.join(map(str, data.columns[:3]))):
+            yield
+    with data_tab:
+        st.dataframe(data, use_container_width=True)
+    with export_tab:
+        st.caption('Tiedosto muodostetaan, kun valitset muodon.')
+        for export_format in export_formats:
+            extension, mime = EXPORT_FORMATS[export_format]
+            if st.button(f'Muodosta {export_format}-tiedosto', key=f'export_{key}_{export_format}'):
+                with metrics.span('chart.export', export_format):
+                    file = export_file(data, export_format)
+                st.download_button(f'Lataa data{extension} ({len(file) / 2 ** 20:.1f} MB)', data=file,
+                                   file_name=f'data{extension}', mime=mime,
+                                   key=f'download_{key}_{export_format}')
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from src import fingridapi, metrics
+from src.cache import cache_data
+
+
+"""
+Wide frames of the Datahub datasets of Fingrid's open data. Datahub rows are split by dimensions such as the customer
+type, consumption size or metering method, and the API returns one row per time and combination of dimension codes.
+The rows are reshaped to one column per combination by scattering the values directly into a preallocated array, as
+every time and combination occurs only once. Wide frames are cached per dataset and month.
+"""
+
+# Dimension code -> name shown in the column names
+DIMENSION_NAMES = {
+    'BE01': 'Asunnot, kerrostalo',
+    'BE02': 'Asunnot, pientalo (rivi-, pari- ja omakotitalo), sähkölämmitteinen',
+    'BE03': 'Asunnot, pientalo (rivi-, pari- ja omakotitalo), ei-sähkölämmitteinen',
+    'BE04': 'Asunnot, vapaa-ajan asunto',
+    'BE05': 'Asuinkiinteistöt',
+    'BE06': 'Maataloustuotanto (TOL A)',
+    'BE07': 'Teollisuus (TOL B ja C)',
+    'BE08': 'Yhdyskuntahuolto tai energia- ja vesihuolto (TOL D, E)',
+    'BE09': 'Rakentaminen (tilapäissähkö) (TOL F)',
+    'BE10': 'Palvelut',
+    'BE11': 'Ulkovalaistus',
+    'BE12': 'Sähköautojen latauspisteet',
+    'BE13': 'Liikenne',
+    'BE14': 'Muu kohde',
+    'AB01': 'Yritys',
+    'AB02': 'Kuluttaja',
+    'AV01': 'Vesivoima',
+    'AV02': 'Tuulivoima',
+    'AV03': 'Ydinvoima',
+    'AV04': 'Kaasuturbiini',
+    'AV05': 'Diesel-voimakone',
+    'AV06': 'Aurinkovoima',
+    'AV07': 'Aaltovoima',
+    'AV08': 'Yhteistuotanto',
+    'AV09': 'Biovoima',
+    'AV10': 'Muu tuotanto',
+    '0': '0-2000 kWh',
+    '2k': '2000-20 000 kWh',
+    '20k': '20 000-100 000 kWh',
+    '100k': 'yli 100 000 kWh',
+    'E13': 'Jatkuva mittaus',
+    'E14': 'Lukemamittaus',
+    'E16': 'Mittaroimaton'
+}
+
+
+def column_name(codes):
+    """
+    :param codes: dimension code or tuple of codes of a column
+    :return: names of the codes joined with ' - ', unknown codes are shown as is
+    """
+    codes = codes if isinstance(codes, tuple) else (codes,)
+    return ' - '.join(DIMENSION_NAMES.get(str(code), str(code)) for code in codes)
+
+
+def to_wide(df, value_column='Value'):
+    """
+    Reshape a long Datahub frame to one column per combination of dimension codes, like pivot_table but without
+    grouping. Rows with a missing dimension are left out and the last value is kept if a time and combination occurs
+    more than once.
+    :param df: long frame with a datetime index, the value column and one column per dimension
+    :param value_column: name of the value column
+    :return: wide frame with the dimension codes as columns (a MultiIndex with several dimensions) sorted by the
+    codes, the frame as is if it has no dimensions
+    """
+    dimensions = [column for column in df.columns if column != value_column]
+    if not dimensions:
+        return df
+    # Dimensions are encoded as integer codes of their sorted distinct values, so the column of a row is a single
+    # integer and the columns sort by the codes of the dimensions in order
+    encoded = [pd.factorize(df[dimension], sort=True) for dimension in dimensions]
+    valid = np.logical_and.reduce([codes >= 0 for codes, _ in encoded])
+    shape = [max(1, len(uniques)) for _, uniques in encoded]
+    combined = np.ravel_multi_index([codes[valid] for codes, _ in encoded], shape)
+    column_ids, columns = np.unique(combined, return_inverse=True)
+    times, rows = np.unique(df.index.asi8[valid], return_inverse=True)
+    wide = np.full((len(times), len(column_ids)), np.nan)
+    wide[rows, columns] = df[value_column].to_numpy(dtype=np.float64)[valid]
+    levels = [np.asarray(uniques, dtype=object)[positions]
+              for (_, uniques), positions in zip(encoded, np.unravel_index(column_ids, shape))]
+    index = pd.to_datetime(times, utc=True).tz_convert(df.index.tz).rename(df.index.name)
+    return pd.DataFrame(wide, index=index, columns=pd.MultiIndex.from_arrays(levels, names=dimensions)
+                        if len(dimensions) > 1 else pd.Index(levels[0], name=dimensions[0]))
+
+
+def _load_months(variableid, chunks):
+    """
+    Load consecutive months with a single ranged request, split them by month and reshape each month to a wide frame
+    :param variableid: dataset id
+    :param chunks: consecutive (year, month) tuples
+    :return: dictionary of (year, month) -> wide frame
+    """
+    first = pd.Timestamp(year=chunks[0][0], month=chunks[0][1], day=1)
+    last = pd.Timestamp(year=chunks[-1][0], month=chunks[-1][1], day=1) + pd.offsets.MonthEnd(0)
+    # Free search can select any dataset, so missing data is always fetched from the API. Months already in the
+    # store are used, but fetched months are only cached in memory, as storing every searched dataset would grow the
+    # store without bound.
+    df = fingridapi.get_data_from_fg_api_with_start_end(variableid, first, last, local_only=False, store=False)
+    frames = {}
+    for chunk in chunks:
+        chunk_start = pd.Timestamp(year=chunk[0], month=chunk[1], day=1, tz='UTC')
+        chunk_end = chunk_start + pd.offsets.MonthBegin(1)
+        frames[chunk] = to_wide(df[(df.index >= chunk_start) & (df.index < chunk_end)])
+    return frames
+
+
+@cache_data()
+def _datahub_chunk(variableid, year, month):
+    return _load_months(variableid, [(year, month)])[(year, month)]
+
+
+@cache_data(ttl=fingridapi.OPEN_CHUNK_TTL)
+def _datahub_open_chunk(variableid, year, month):
+    return _load_months(variableid, [(year, month)])[(year, month)]
+
+
+@metrics.timed('datahub.get')
+def get_dataset_df(variableid, start, end):
+    """
+    Get any dataset of Fingrid's open data between the start and end dates, Datahub datasets as wide frames. Months
+    are reshaped separately and cached, closed months without expiry and months still within the settlement window
+    for OPEN_CHUNK_TTL. Consecutive months missing from the cache are fetched with one ranged request.
+    :param variableid: dataset id
+    :param start: start date
+    :param end: end date (inclusive)
+    :return: dataframe with a Value column, or with one column per combination of dimensions for Datahub datasets
+    """
+    start_ts = pd.Timestamp(start.strftime("%Y-%m-%d"), tz='UTC')
+    end_ts = pd.Timestamp(end.strftime("%Y-%m-%d") + " 23:59", tz='UTC')
+    chunks = [(month.year, month.month)
+              for month in pd.period_range(start_ts.tz_localize(None), end_ts.tz_localize(None), freq='M')]
+    caches = {chunk: _datahub_chunk if fingridapi.is_closed(chunk) else _datahub_open_chunk for chunk in chunks}
+    frames = {}
+    for chunk in chunks:
+        hit, frame = caches[chunk].get_cached(variableid, *chunk)
+        if hit:
+            frames[chunk] = frame
+    for run in fingridapi.month_runs([chunk for chunk in chunks if chunk not in frames]):
+        for chunk, frame in _load_months(variableid, run).items():
+            frames[chunk] = caches[chunk].set_cached(frame, variableid, *chunk)
+    frames = [frames[chunk] for chunk in chunks]
+    # Months without data have only the Value column
+    df = pd.concat([frame for frame in frames if not frame.empty] or frames[:1])
+    df = df[(df.index >= start_ts) & (df.index <= end_ts)]
+    if 'Value' in df.columns:
+        return df
+    # Combinations missing from some of the months are NaN in them
+    df = df.sort_index(axis=1)
+    df.columns = [column_name(codes) for codes in df.columns]
+    return df
@@ -0,0 +1,210 @@
+import numpy as np
+import pandas as pd
+from src import fingridapi, metrics, storage
+from src.cache import tiered_cache_data
+from src.general_functions import check_previous_data
+from src.fingridapi import get_data_from_fg_api_with_start_end, get_multiple_from_fg_api
+from src.fmi_api import temperatures
+
+
+"""
+Datasets and data loaders used by the pages. The pages, the background ingestion (src/ingest.py) and the benchmarks
+(benchmarks/run.py) share these definitions, so the ingestion keeps exactly the data the pages read up to date and the
+benchmarks measure the same code the pages run.
+"""
+
+generation_mapping = {'Ydinvoima': 188,
+                      'Kaukolämmön yhteistuotanto': 201,
+                      'Teollisuuden yhteistuotanto': 202,
+                      'Muu tuotanto': 205,
+                      'Tuulivoima': 181,
+                      'Vesivoima': 191,
+                      'Nettotuonti/-vienti': 194,
+                      'Tuotanto': 192,
+                      'Kulutus': 193}
+
+estlink_map = {'Kaupallinen siirto': 140,
+               'Vientikapasiteetti': 115,
+               'Tuontikapasiteetti': 112}
+
+fennoskan_map = {'Kaupallinen siirto': 32,
+                 'Vientikapasiteetti': 27,
+                 'Tuontikapasiteetti': 25}
+
+rac_map = {'Kaupallinen siirto': 31,
+           'Vientikapasiteetti': 26,
+           'Tuontikapasiteetti': 24}
+
+WIND_PRODUCTION_ID = 75
+WIND_CAPACITY_ID = 268
+PRODUCTION_ID = 74
+DEMAND_ID = 124
+
+# Every Fingrid dataset read by the pages
+FINGRID_DATASETS = sorted({WIND_PRODUCTION_ID, WIND_CAPACITY_ID, PRODUCTION_ID, DEMAND_ID,
+                           *generation_mapping.values(), *estlink_map.values(), *fennoskan_map.values(),
+                           *rac_map.values()})
+
+
+def update_wind_corr_data(start, end):
+    """
+    Fetch wind production and capacity values missing from the local store up to the end date
+    :param start: start date used if the store is empty
+    :param end: end date
+    """
+    new_start_time = check_previous_data(storage.last_timestamp('wind_corr'), start)
+    end = pd.to_datetime(end)
+    if end.tzinfo is None:
+        end = end.tz_localize('Europe/Helsinki')
+
+    if new_start_time <= end:
+        new_df = get_data_from_fg_api_with_start_end(WIND_PRODUCTION_ID, new_start_time, end)
+
+        new_df.rename({'Value': 'Tuulituotanto'}, axis=1, inplace=True)
+
+        wind_capacity = get_data_from_fg_api_with_start_end(WIND_CAPACITY_ID, new_start_time, end)
+        # Fixing issues in the API capacity (sometimes capacity is missing and API gives low value)
+        wind_capacity.loc[wind_capacity['Value'] < wind_capacity['Value'].shift(-24), 'Value'] = np.NaN
+        new_df['Kapasiteetti'] = wind_capacity['Value']
+        # Due to issues with input data with strange timestamps, we need to resample the data
+        new_df = new_df.resample('H')
+        # Interpolate missing values linearly
+        new_df = new_df.interpolate('time')
+        # Store replaces already stored hours, so overlapping fetches don't create duplicates
+        storage.append('wind_corr', new_df)
+
+
+def update_temperature_data(start_time, end_date):
+    """
+    Fetch temperatures missing from the local store up to the end date
+    :param start_time: start time used if the store is empty
+    :param end_date: end date
+    """
+    new_start_time = check_previous_data(storage.last_timestamp('temperatures'), start_time)
+    # FMI API uses naive UTC timestamps
+    if new_start_time.tzinfo is not None:
+        new_start_time = new_start_time.tz_convert('UTC').tz_localize(None)
+
+    # Fetch new data only if there's a gap between old data and end_time
+    if new_start_time <= pd.to_datetime(end_date):
+        storage.append('temperatures', temperatures(new_start_time, end_date))
+
+
+@tiered_cache_data(fingridapi.SETTLEMENT, show_spinner=False)
+def get_demand_df(start, end):
+    """
+    Get the demand values from Fingrid API between the start and end dates
+    :param start: start date
+    :param end: end date
+    :return: demand dataframe
+    """
+    demand_df = get_data_from_fg_api_with_start_end(DEMAND_ID, start, end)
+    demand_df.rename({'Value': 'Kulutus'}, axis=1, inplace=True)
+    return demand_df
+
+
+@metrics.timed('get_wind_df')
+def get_wind_df(start, end):
+    """
+    Get the wind production and capacity values from Fingrid API between the start and end dates.
+    Calculates the utilization rate
+    :param start: start date
+    :param end: end date
+    :return: wind dataframe
+    """
+
+    df = get_data_from_fg_api_with_start_end(WIND_PRODUCTION_ID, start, end)
+    df.rename({'Value': 'Tuulituotanto'}, axis=1, inplace=True)
+
+    wind_capacity = get_data_from_fg_api_with_start_end(WIND_CAPACITY_ID, start, end)
+    # Fixing issues in the API capacity (sometimes capacity is missing and API gives low value)
+    wind_capacity.loc[wind_capacity['Value'] < wind_capacity['Value'].shift(-24), 'Value'] = np.NaN
+    df['Kapasiteetti'] = wind_capacity['Value']
+    # Due to issues with input data with strange timestamps, we need to resample the data
+    df = df.resample('H')
+    # Interpolate missing values linearly
+    df = df.interpolate()
+
+    df['Käyttöaste'] = df['Tuulituotanto'] / df['Kapasiteetti'] * 100
+    return df.round(1)
+
+
+@tiered_cache_data(fingridapi.SETTLEMENT, show_spinner=False)
+def get_flows_and_capacities_df(start, end, flow_mapping):
+    """
+    Get the commercial flows and capacity values from Fingrid API between the start and end dates
+    :param start: start date
+    :param end: end date
+    :return: production dataframe with demand values included
+    """
+
+    result = get_multiple_from_fg_api(flow_mapping, start, end)
+    # export is expected to be positive always
+    result['Vientikapasiteetti'] = abs(result['Vientikapasiteetti'])
+    result['Tuontikapasiteetti'] = result['Tuontikapasiteetti'] * -1
+    return result
+
+
+@tiered_cache_data(fingridapi.SETTLEMENT, show_spinner=False)
+def get_production_and_demand_df(start, end):
+    """
+    Get the production and  demand values from Fingrid API between the start and end dates
+    :param start: start date
+    :param end: end date
+    :return: production dataframe with demand values included
+    """
+    demand_df = get_data_from_fg_api_with_start_end(DEMAND_ID, start, end)
+    demand_df.rename({'Value': 'Kulutus'}, axis=1, inplace=True)
+    production_df = get_data_from_fg_api_with_start_end(PRODUCTION_ID, start, end)
+    production_df.rename({'Value': 'Tuotanto'}, axis=1, inplace=True)
+    production_df['Kulutus'] = demand_df['Kulutus']
+    production_df['Tase'] = production_df['Tuotanto'] - production_df['Kulutus']
+
+    # Due to issues with input data with strange timestamps, we need to resample the data
+    production_df = production_df.resample('H')
+    # Interpolate missing values linearly
+    production_df = production_df.interpolate()
+    return production_df
+
+
+@tiered_cache_data(fingridapi.SETTLEMENT, show_spinner=False)
+def get_generations_df(start, end):
+    """
+    Get the generation values from Fingrid API between the start and end dates
+    :param start: start date
+    :param end: end date
+    :return: production dataframe with demand values included
+    """
+    result = get_multiple_from_fg_api(generation_mapping, start, end)
+    # Solar production is not available from API but can be calculated
+    solar = result['Tuotanto'] - result[result.columns[0:6]].sum(axis=1)
+    result.insert(5, 'Aurinkovoima', solar)
+
+    return result
+
+
+@metrics.timed('get_aggregated_data')
+def get_aggregated_data(start, end, aggregation_selection, with_price=False):
+    """
+    Get the aggregated temperature, wind and optionally price values from the precomputed rollups of the stored
+    series, so changing the aggregation level doesn't resample the whole history.
+    :param start: start date
+    :param end: end date (inclusive)
+    :param aggregation_selection: aggregation level
+    :param with_price: include Finnish day-ahead price
+    :return: aggregated dataframe
+    """
+    start = pd.to_datetime(start).tz_localize('Europe/Helsinki')
+    # The buckets at the ends of the range only include the data inside it
+    end = (pd.to_datetime(end) + pd.Timedelta(days=1)).tz_localize('Europe/Helsinki') - pd.Timedelta(1)
+    temperature_df = storage.read_rollup('temperatures', aggregation_selection, start, end)
+    temperature_df['Keskilämpötila'] = temperature_df.mean(axis=1)
+    wind_df = storage.read_rollup('wind_corr', aggregation_selection, start, end)
+    # Utilization rate of the aggregated period is calculated from the produced energy and the available capacity
+    wind_sums = storage.read_rollup('wind_corr', aggregation_selection, start, end, stat='sum')
+    wind_df['Käyttöaste'] = wind_sums['Tuulituotanto'] / wind_sums['Kapasiteetti'] * 100
+    dfs = [temperature_df, wind_df]
+    if with_price:
+        price_df = storage.read_rollup('price_FI', aggregation_selection, start, end)
+        dfs.append(price_df.rename({'FI': 'Hinta'}, axis=1))
+    return pd.concat(dfs, axis=1, join='inner').round(1)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+Compact dtypes for the loaded frames. Measurements are kept as float32 when the values survive the conversion within
+FLOAT32_TOLERANCE, and repeating text columns (e.g. the Datahub dimensions) as categoricals, which roughly halves the
+memory of every cached frame. Calendar fields used for grouping the charts are computed from the index when needed
+instead of being stored as string columns.
+"""
+
+# Largest allowed absolute error of a float32 value, the pages show at most one decimal
+FLOAT32_TOLERANCE = 0.005
+# Text columns with at most this share of unique values are converted to categoricals
+MAX_CATEGORY_RATIO = 0.5
+
+CALENDAR_FIELDS = {'Vuosi': lambda index: index.year,
+                   'Kuukausi': lambda index: index.month,
+                   'Viikonpäivä': lambda index: index.dayofweek,
+                   'Päivä': lambda index: index.day,
+                   'Tunti': lambda index: index.hour}
+
+
+def _compact_column(values):
+    if values.dtype == np.float64:
+        compact = values.astype(np.float32)
+        difference = np.abs(compact.to_numpy(dtype=np.float64) - values.to_numpy())
+        if not (difference > FLOAT32_TOLERANCE).any():
+            return compact
+    elif values.dtype == object and len(values) and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+        if values.nunique(dropna=True) <= len(values) * MAX_CATEGORY_RATIO:
+            return values.astype('category')
+    return values
+
+
+def compact(data):
+    """
+    Convert the float64 measurements of a frame to float32 and repeating text columns to categoricals
+    :param data: dataframe or series
+    :return: data with compact dtypes, the same object if nothing was converted
+    """
+    if isinstance(data, pd.Series):
+        return _compact_column(data)
+    if data.columns.has_duplicates:
+        return data
+    columns = {column: _compact_column(data[column]) for column in data.columns}
+    converted = [column for column, values in columns.items() if values.dtype != data[column].dtype]
+    if not converted:
+        return data
+    data = data.copy(deep=False)
+    for column in converted:
+        data[column] = columns[column]
+    return data
+
+
+def memory_usage(data):
+    """
+    :return: memory used by the dataframe or series in bytes, including the index and strings
+    """
+    usage = data.memory_usage(deep=True)
+    return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+
+
+def calendar_field(index, field):
+    """
+    Calendar field of a datetime index as a categorical series, e.g. for splitting charts by year. Only the distinct
+    values are converted to strings, so the result takes a few bytes per row.
+    :param index: datetime index
+    :param field: name of the field, one of CALENDAR_FIELDS
+    :return: categorical series aligned with the index
+    """
+    codes, uniques = pd.factorize(CALENDAR_FIELDS[field](index), sort=True)
+    categories = pd.Index(uniques).astype(str)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=index, name=field)
@@ -1,55 +1,212 @@
 import entsoe.exceptions
+import numpy as np
 import pandas as pd
+import requests
 from entsoe import EntsoePandasClient
-from src.general_functions import check_previous_data
+from concurrent.futures import ThreadPoolExecutor
+from src import metrics, storage, transport
+from src.cache import settled_until, tiered_cache_data
+from src.singleflight import SingleFlight
 import os
-import pytz
-import streamlit as st
+import time
 
-@st.cache_data(show_spinner=False, max_entries=200, persist=True)
-def get_finnish_price_data(start, end):
-    old_df = pd.read_csv('./data/old_finnish_price_data.csv')
-    old_df['Aikaleima'] = pd.to_datetime(old_df['Aikaleima'])
-    old_df.set_index(['Aikaleima'], inplace=True)
 
-    new_start_time = check_previous_data(old_df, start)
-    if new_start_time.date() <= end:
-        token = os.environ['ENTSO_TOKEN']
-        tz_pytz = pytz.timezone("Etc/GMT+3")
-        client = EntsoePandasClient(api_key=token)
+# Nordic and Baltic bidding zones kept up to date by the background ingestion
+NORDIC_BALTIC_AREAS = ['FI', 'SE1', 'SE2', 'SE3', 'SE4', 'NO1', 'NO2', 'NO3', 'NO4', 'NO5', 'DK1', 'DK2',
+                       'EE', 'LV', 'LT']
+
+# Number of chunks fetched concurrently and attempts per chunk
+MAX_WORKERS = int(os.environ.get('ENTSOE_MAX_WORKERS', 4))
+RETRIES = 3
+
+# Prices of a day are final once they are published on the previous day, so only the prices from yesterday onwards
+# are treated as changing (tomorrow's prices appear in the afternoon)
+SETTLEMENT = pd.Timedelta(days=1)
+
+# Days with fewer stored prices are fetched again, a day has 23-25 hourly prices
+MIN_VALUES_PER_DAY = 23
+TIMEZONE = 'Europe/Helsinki'
+
+# Sessions requesting the same prices at the same time share one request to ENTSO-E
+_flight = SingleFlight('entsoe')
+
+
+def _series(area):
+    return f'price_{area}'
+
 
-        start_ts = pd.to_datetime(new_start_time, utc=True).tz_convert('Etc/GMT+3')
-        end_ts = pd.to_datetime(end, utc=True).tz_convert('Etc/GMT+3') + pd.to_timedelta(1, 'd')
+def _entsoe_area(area):
+    """
+    Name of the bidding zone in the ENTSO-E client, which separates the number of the zone, e.g. SE_1 for SE1
+    """
+    return f'{area[:-1]}_{area[-1]}' if area[-1].isdigit() else area
 
-        country_code = 'FI'
+
+@metrics.timed('entsoe.request')
+def _query_prices(area, start_ts, end_ts):
+    """
+    Query day-ahead prices of a single area and chunk through the shared transport. Connection errors and the
+    transient statuses of transport.RETRY_STATUSES are retried with exponential backoff, throttled requests after the
+    time given in the Retry-After header. Other errors are raised at once.
+    :return: series of prices, empty if ENTSO-E has no data for the chunk
+    """
+    client = EntsoePandasClient(api_key=os.environ['ENTSO_TOKEN'], session=transport.get_transport())
+    for attempt in range(RETRIES):
         try:
-            df = client.query_day_ahead_prices(country_code, start=start_ts, end=end_ts)
-            df.name = 'FI'
-            df.index.name = 'Aikaleima'
-            df = pd.DataFrame(df)
-            df = pd.concat([old_df, df])
-            df = df['FI']
-            df.to_csv('./data/old_finnish_price_data.csv')
+            return client.query_day_ahead_prices(_entsoe_area(area), start=start_ts, end=end_ts)
         except entsoe.exceptions.NoMatchingDataError:
-            df = old_df
-    else:
-        df = old_df
+            return pd.Series(dtype=np.float64)
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            response = getattr(e, 'response', None)
+            transient = isinstance(e, requests.ConnectionError) or (
+                response is not None and response.status_code in transport.RETRY_STATUSES)
+            if not transient or attempt == RETRIES - 1:
+                raise
+            delay = transport.retry_delay(response, attempt)
+            print(f'{area} {start_ts:%Y-%m-%d} - {end_ts:%Y-%m-%d} failed ({e}), retrying in {delay:.1f} s')
+            time.sleep(delay)
+
+
+def _year_chunks(start_ts, end_ts):
+    """
+    Split the range into calendar year sized chunks (UTC), the API doesn't return more than a year at a time
+    """
+    bounds = [start_ts] + [pd.Timestamp(year=year, month=1, day=1, tz='UTC')
+                           for year in range(start_ts.year + 1, end_ts.year + 1)] + [end_ts]
+    return [(chunk_start, chunk_end) for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:])
+            if chunk_end > chunk_start]
+
+
+def _days(start_ts, end_ts):
+    """
+    Finnish days between the timestamps
+    :return: DatetimeIndex of the UTC starts of the days
+    """
+    return pd.date_range(start_ts.tz_convert(TIMEZONE), end_ts.tz_convert(TIMEZONE), freq='D',
+                         inclusive='left').tz_convert('UTC')
+
+
+def _missing_days(area, start_ts, end_ts):
+    """
+    Days of the window without complete stored prices of the area, leaving out the days ENTSO-E has been found to
+    have no prices for. Coverage is read from the daily rollup of the stored prices, so the prices themselves are not
+    loaded.
+    :return: DatetimeIndex of the UTC starts of the days
+    """
+    counts = storage.read_rollup(_series(area), 'Päivä', start_ts, end_ts - pd.Timedelta(1), stat='count')
+    covered = counts.index[counts[area] >= MIN_VALUES_PER_DAY] if area in counts else counts.index[:0]
+    return _days(start_ts, end_ts).difference(covered.tz_convert('UTC')).difference(
+        storage.known_gaps(_series(area)))
+
+
+def _ranges(days):
+    """
+    Group days into ranges of consecutive days
+    :param days: sorted DatetimeIndex of the UTC starts of Finnish days
+    :return: list of (start, end) UTC timestamps, end being the start of the day after the range
+    """
+    ranges = []
+    for day in days:
+        day_end = (day.tz_convert(TIMEZONE) + pd.DateOffset(days=1)).tz_convert('UTC')
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], day_end)
+        else:
+            ranges.append((day, day_end))
+    return ranges
+
+
+def _day_start(day):
+    return pd.Timestamp(day.strftime('%Y-%m-%d'), tz=TIMEZONE).tz_convert('UTC')
+
+
+@metrics.timed('entsoe.update')
+def update_area_price_data(areas, start, end, max_workers=MAX_WORKERS):
+    """
+    Fetch day-ahead prices of the areas missing from the local store. Ranges of missing days are split into year
+    sized chunks, which are fetched for all areas in parallel and stored in the same store as the Finnish prices.
+    Settled days ENTSO-E has no prices for are recorded, so they are not requested again. Prices of the chunks that
+    succeeded are stored even if other chunks fail, after which the first failure is raised.
+    :param areas: list of bidding zones (e.g. ['FI', 'SE1', 'EE'])
+    :param start: start date
+    :param end: end date, prices of the next day are included when they have been published
+    :param max_workers: number of concurrent requests
+    """
+    start_ts = _day_start(start)
+    end_ts = _day_start(end + pd.Timedelta(days=2))
+    missing = {area: _missing_days(area, start_ts, end_ts) for area in areas}
+    tasks = [(area, chunk_start, chunk_end) for area in areas
+             for range_start, range_end in _ranges(missing[area])
+             for chunk_start, chunk_end in _year_chunks(range_start, range_end)]
+    if not tasks:
+        return
+    prices = {area: [] for area in areas}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Chunks already being fetched by another session are waited for instead of fetched again
+        futures = [executor.submit(_flight.do, task, _query_prices, *task) for task in tasks]
+        for (area, _, _), future in zip(tasks, futures):
+            try:
+                df = future.result()
+            except Exception as e:
+                failures.setdefault(area, e)
+                continue
+            if not df.empty:
+                prices[area].append(df)
+    settled = pd.Timestamp(str(settled_until(SETTLEMENT)), tz=TIMEZONE)
+    for area, dfs in prices.items():
+        df = pd.concat(dfs) if dfs else pd.Series(dtype=np.float64, index=pd.DatetimeIndex([], tz=TIMEZONE))
+        if dfs:
+            df.name = area
+            df.index.name = 'Aikaleima'
+            storage.append(_series(area), pd.DataFrame(df))
+        if area not in failures:
+            # Days of the queried ranges without complete prices are gaps, unless their prices may still be published
+            returned = df.groupby(df.index.tz_convert(TIMEZONE).normalize()).count()
+            complete = returned.index[returned >= MIN_VALUES_PER_DAY].tz_convert('UTC')
+            gaps = missing[area].difference(complete)
+            storage.add_known_gaps(_series(area), gaps[gaps < settled])
+    if failures:
+        raise next(iter(failures.values()))
+
+
+def update_finnish_price_data(start, end):
+    """
+    Fetch Finnish day-ahead prices missing from the local store up to the end date
+    :param start: start date used if the store is empty
+    :param end: end date
+    """
+    update_area_price_data(['FI'], start, end)
+
+
+@metrics.timed('entsoe.read')
+def _read_prices(areas, start, end):
     start = pd.to_datetime(start).tz_localize('Europe/Helsinki')
     end = pd.to_datetime(end).tz_localize('Europe/Helsinki') + pd.to_timedelta(1, 'day')
-    df = df['FI']
-    return df.loc[start:end].round(1)
-
-@st.cache_data(show_spinner=False, max_entries=200)
-def get_area_price_data(start, end, area, _daterange=None):
-    token = os.environ['ENTSO_TOKEN']
-    tz_pytz = pytz.timezone("Etc/GMT+3")
-    client = EntsoePandasClient(api_key=token)
-    if _daterange == None:
-        start_ts = pd.to_datetime(start, utc=True).tz_convert('Etc/GMT+3')
-        end_ts = pd.to_datetime(end, utc=True).tz_convert('Etc/GMT+3')
-    else:
-        start_ts = _daterange[0]
-        end_ts = _daterange[-1]
-    df = client.query_day_ahead_prices(area, start=start_ts, end=end_ts)
-    df.name = area
+    dfs = []
+    for area in areas:
+        df = storage.read(_series(area), start, end)
+        dfs.append(df[area] if area in df else pd.Series(index=df.index, dtype=np.float64, name=area))
+    df = pd.concat(dfs, axis=1)
+    df.index = df.index.tz_convert('Europe/Helsinki')
     return df
+
+
+@tiered_cache_data(SETTLEMENT, show_spinner=False)
+def get_finnish_price_data(start, end):
+    if not storage.LOCAL_ONLY:
+        update_finnish_price_data(start, end)
+    return _read_prices(['FI'], start, end)['FI'].round(1)
+
+
+@tiered_cache_data(SETTLEMENT, show_spinner=False)
+def get_price_data(areas, start, end):
+    """
+    Get day-ahead prices of several bidding zones, e.g. for price spread analysis
+    :param areas: list of bidding zones
+    :param start: start date
+    :param end: end date (inclusive)
+    :return: dataframe with one column per area aligned by timestamp in Finnish time
+    """
+    if not storage.LOCAL_ONLY:
+        update_area_price_data(areas, start, end)
+    return _read_prices(areas, start, end)
@@ -1,64 +1,282 @@
 import os, requests
+import numpy as np
 import pandas as pd
 import streamlit as st
 import json
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import asyncio
+from src import metrics, storage, transport
+from src.ratelimit import TokenBucket
+from src.singleflight import SingleFlight
+
+
+FG_API_URL = 'https://data.fingrid.fi/api'
+PAGE_SIZE = 20000
+# Maximum number of pages fetched concurrently
+MAX_WORKERS = int(os.environ.get('FG_MAX_WORKERS', 4))
+# Attempts per request when Fingrid throttles (429) or fails
+RETRIES = 5
+
+# Datahub metadata fields that are not needed in the returned data
+DATAHUB_DROPPED_FIELDS = ('Value', 'TimeSeriesType', 'Res', 'Uom', 'ReadTS', 'Count')
+
+# Process-wide limit for requests sent to Fingrid (requests per second and burst size)
+_limiter = TokenBucket(rate=float(os.environ.get('FG_RATE_LIMIT', 1.0)),
+                       capacity=int(os.environ.get('FG_RATE_BURST', 10)))
+
+# Chunks of months that are not closed yet are kept in memory for a while, closed months are stored permanently
+OPEN_CHUNK_TTL = 300
+# Real-time measurements may still be corrected during the following days, older data is final. Both the monthly
+# chunks and the tiered caches of the datasets (src/datasets.py) treat data as final after this window.
+SETTLEMENT = pd.Timedelta(days=2)
+_open_chunks = {}
+_open_chunks_lock = threading.Lock()
+
+# Sessions missing the same months of a dataset at the same time share one request
+_flight = SingleFlight('fingrid')
+
+
+def request(url, headers):
+    """
+    Send a request through the shared rate limiter. Throttled (429) and failed requests are retried after the time
+    given in the Retry-After header, or with exponential backoff if the header is missing.
+    :param url: url of the request
+    :param headers: request headers, e.g. the API key
+    :return: successful response
+    """
+    for attempt in range(RETRIES):
+        _limiter.acquire()
+        try:
+            res = transport.get_transport().get(url, headers=headers)
+        except requests.ConnectionError as e:
+            if attempt == RETRIES - 1:
+                raise
+            delay = transport.retry_delay(None, attempt)
+            print(f'Fingrid request failed ({e}), retrying in {delay:.1f} s')
+        else:
+            if res.status_code not in transport.RETRY_STATUSES or attempt == RETRIES - 1:
+                res.raise_for_status()
+                return res
+            delay = transport.retry_delay(res, attempt)
+            print(f'Fingrid responded {res.status_code}, retrying in {delay:.1f} s')
+        time.sleep(delay)
+
+
+@metrics.timed('fingrid.request')
+def _get_page(variableid, start_str, end_str, headers, page):
+    res = request(f'{FG_API_URL}/datasets/{variableid}/data?startTime={start_str}Z&'
+                   f'endTime={end_str}Z&format=json&oneRowPerTimePeriod=true&pageSize={PAGE_SIZE}&page={page}&'
+                   f'locale=fi&sortBy=startTime&sortOrder=asc',
+                   headers)
+    # json accepts the raw response bytes, so the payload is parsed once without decoding it to a string first
+    return json.loads(res.content)
+
+
+def _empty_frame():
+    return pd.DataFrame({'Value': []}, index=pd.DatetimeIndex([], tz='Europe/Helsinki', name='Aikaleima'))
+
+
+def _fetch_range(variableid, start_str, end_str, headers, max_workers):
+    response = _get_page(variableid, start_str, end_str, headers, 1)
+    pages = [response['data']]
+    num_of_pages = response['pagination']['lastPage']
+    if num_of_pages > 1:
+        # Fetch the rest of the pages concurrently, map keeps the page order
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            responses = executor.map(lambda page: _get_page(variableid, start_str, end_str, headers, page),
+                                     range(2, num_of_pages + 1))
+            pages.extend(next_response['data'] for next_response in responses)
+    return _decode_rows([row for page in pages for row in page])
+
+
+def _parse_timestamps(timestamps):
+    """
+    Parse timestamps in Fingrid's fixed ISO format in one vectorized call
+    """
+    try:
+        return pd.to_datetime(timestamps, format='%Y-%m-%dT%H:%M:%S.%fZ', utc=True)
+    except ValueError:
+        return pd.to_datetime(timestamps, utc=True)
+
+
+@metrics.timed('fingrid.decode')
+def _decode_rows(rows):
+    """
+    Build typed columns directly from the data rows of the API response. Datahub datasets include an additional JSON
+    string per row, which are all parsed with a single json.loads call.
+    :param rows: list of row dictionaries from all pages
+    :return: dataframe indexed by timestamps in Finnish time
+    """
+    if not rows:
+        return _empty_frame()
+    index = _parse_timestamps(np.array([row['startTime'] for row in rows], dtype=object))
+    index = index.tz_convert('Europe/Helsinki').rename('Aikaleima')
+    columns = {'Value': np.array([row['value'] for row in rows], dtype=np.float64)}
+    # Handle potential additional JSON data from Datahub data
+    extra_keys = [key for key in rows[0].keys() if key not in ('startTime', 'endTime', 'value')]
+    if extra_keys:
+        additional = json.loads('[' + ','.join(row[extra_keys[0]] or '{}' for row in rows) + ']')
+        for key in next((item for item in additional if item), {}).keys():
+            if key not in DATAHUB_DROPPED_FIELDS:
+                columns[key] = [item.get(key) for item in additional]
+    return pd.DataFrame(columns, index=index)
+
+
+def _next_chunk(chunk):
+    year, month = chunk
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _chunk_bounds(chunk):
+    """
+    UTC start of the given (year, month) chunk and the start of the next chunk
+    """
+    next_year, next_month = _next_chunk(chunk)
+    return (pd.Timestamp(year=chunk[0], month=chunk[1], day=1, tz='UTC'),
+            pd.Timestamp(year=next_year, month=next_month, day=1, tz='UTC'))
+
+
+def is_closed(chunk):
+    """
+    A month is closed once its last values are older than SETTLEMENT, as they may still be corrected until then
+    :param chunk: (year, month) tuple
+    :return: True if the data of the month is final
+    """
+    return _chunk_bounds(chunk)[1] + SETTLEMENT <= pd.Timestamp.now(tz='UTC')
+
+
+def _read_stored_chunk(series, chunk):
+    df = storage.read_partition(series, *chunk)
+    if df is not None:
+        df.index = df.index.tz_convert('Europe/Helsinki')
+    return df
+
+
+def _get_cached_chunk(variableid, chunk, local_only):
+    if local_only:
+        # Background ingestion keeps the ongoing month in a separate series until the month is closed
+        df = _read_stored_chunk(f'fingrid_{variableid}', chunk) if is_closed(chunk) else None
+        if df is None:
+            df = _read_stored_chunk(f'fingrid_{variableid}_recent', chunk)
+        return df if df is not None else _empty_frame()
+    if is_closed(chunk):
+        return _read_stored_chunk(f'fingrid_{variableid}', chunk)
+    with _open_chunks_lock:
+        cached = _open_chunks.get((variableid, chunk))
+    if cached is not None and time.monotonic() - cached[0] < OPEN_CHUNK_TTL:
+        return cached[1]
+    return None
+
+
+def _set_cached_chunk(variableid, chunk, df, store=True):
+    if is_closed(chunk):
+        if store:
+            # Closed months don't change anymore, so they are stored on disk and shared by all pages
+            storage.write_partition(f'fingrid_{variableid}', *chunk, df)
+            # The month was kept in the separate series while it was open, which is no longer needed
+            storage.delete_partition(f'fingrid_{variableid}_recent', *chunk)
+    else:
+        with _open_chunks_lock:
+            _open_chunks[(variableid, chunk)] = (time.monotonic(), df)
+        if store:
+            # Ongoing month is also stored separately, so pages running in local only mode can read it
+            storage.write_partition(f'fingrid_{variableid}_recent', *chunk, df)
+
+
+def month_runs(chunks):
+    """
+    Group sorted (year, month) chunks into runs of consecutive months
+    :param chunks: sorted list of (year, month) tuples
+    :return: list of runs, each a list of consecutive chunks
+    """
+    runs = []
+    for chunk in chunks:
+        if runs and chunk == _next_chunk(runs[-1][-1]):
+            runs[-1].append(chunk)
+        else:
+            runs.append([chunk])
+    return runs
+
+
+def _fetch_chunks(variableid, chunks, headers, max_workers, store=True):
+    """
+    Fetch the given chunks and cache them. Another session may have cached some of them while waiting for the
+    in-flight registry, so the cache is checked again first.
+    :param store: write the fetched chunks to the local store, otherwise they are only cached in memory
+    :return: dictionary of (variableid, chunk) -> dataframe
+    """
+    frames = {chunk: _get_cached_chunk(variableid, chunk, False) for chunk in chunks}
+    # Fetch missing consecutive months with a single ranged request each
+    for run in month_runs([chunk for chunk in chunks if frames[chunk] is None]):
+        run_start = _chunk_bounds(run[0])[0]
+        run_end = _chunk_bounds(run[-1])[1] - pd.Timedelta(minutes=1)
+        df = _fetch_range(variableid, run_start.strftime("%Y-%m-%dT%H:%M:%S"), run_end.strftime("%Y-%m-%dT%H:%M:%S"),
+                          headers, max_workers)
+        for chunk in run:
+            chunk_start, chunk_end = _chunk_bounds(chunk)
+            frames[chunk] = df[(df.index >= chunk_start) & (df.index < chunk_end)]
+            _set_cached_chunk(variableid, chunk, frames[chunk], store)
+    return {(variableid, chunk): df for chunk, df in frames.items()}
 
 
 """
-Reads json-file given by Fingrid's open data API and converts it to list of timestamps and values
+Reads json-file given by Fingrid's open data API and converts it to list of timestamps and values.
+Data is cached in monthly chunks per dataset, so only the months missing from the cache are fetched from the API.
+Fetched months are written to the local store unless store is False, e.g. for datasets that are only viewed once.
 """
 
-def get_data_from_fg_api_with_start_end(variableid, start, end, apikey=None):
+@metrics.timed('fingrid.get')
+def get_data_from_fg_api_with_start_end(variableid, start, end, apikey=None, max_workers=MAX_WORKERS, local_only=None,
+                                        store=True):
     if not apikey:
-        headers = {'x-api-key': os.environ['FGAPIKEY']}
+        headers = {'x-api-key': os.environ.get('FGAPIKEY')}
     else:
         headers = {'x-api-key': apikey}
-    start_str = start.strftime("%Y-%m-%dT") + "00:00:00"
-    end_str = end.strftime("%Y-%m-%dT") + "23:59:00"
-    res = requests.api.get(f'https://data.fingrid.fi/api/datasets/{variableid}/data?startTime={start_str}Z&'
-                           f'endTime={end_str}Z&format=json&oneRowPerTimePeriod=true&pageSize=20000&'
-                           f'locale=fi&sortBy=startTime&sortOrder=asc',
-                           headers=headers)
-    res_decoded = res.content.decode('utf-8')
-    response = json.loads(res_decoded)
-    df = pd.DataFrame(response['data'])
-    num_of_pages = response['pagination']['lastPage']
-    if num_of_pages > 1:
-        for page in range(2, num_of_pages + 1):
-            next_res = requests.api.get(
-                f'https://data.fingrid.fi/api/datasets/{variableid}/data?startTime={start_str}Z&'
-                f'endTime={end_str}Z&format=json&oneRowPerTimePeriod=true&pageSize=20000&page={page}&'
-                f'locale=fi&sortBy=startTime&sortOrder=asc',
-                headers=headers)
-            next_res_decoded = next_res.content.decode('utf-8')
-            next_df = pd.DataFrame(json.loads(next_res_decoded)['data'])
-            df = pd.concat([df, next_df])
-    # Handle potential additional JSON data from Datahub data
-    if len(df.columns) > 3:
-        df.columns = ['Aikaleima', 'End', 'Value', 'JSON']
-        df['JSON'] = df['JSON'].apply(json.loads)
-        new_df = pd.json_normalize(df['JSON'])
-        #st.dataframe(new_df)
-        new_df.drop(['Value'], inplace=True, axis=1)
-        new_df.index = df.index
-        df = pd.concat([df, new_df], axis=1)
-
-
-        #df = pd.pivot_table(data=df, index='Aikaleima', columns=df.columns[-2], values='Value')
-        df.drop(['End', 'JSON', 'TimeSeriesType', 'Res', 'Uom', 'ReadTS', 'Count'], inplace=True, axis=1)
-    else:
-        df.columns = ['Aikaleima', 'End', 'Value']
+    start_ts = pd.Timestamp(start.strftime("%Y-%m-%d"), tz='UTC')
+    end_ts = pd.Timestamp(end.strftime("%Y-%m-%d") + " 23:59", tz='UTC')
+    chunks = [(month.year, month.month) for month in pd.period_range(start_ts.tz_localize(None),
+                                                                      end_ts.tz_localize(None), freq='M')]
+    frames = {}
+    for chunk in chunks:
+        frames[chunk] = _get_cached_chunk(variableid, chunk,
+                                          storage.LOCAL_ONLY if local_only is None else local_only)
+        metrics.count_cache('fingrid_chunks', hit=frames[chunk] is not None)
+    missing = [(variableid, chunk) for chunk in chunks if frames[chunk] is None]
+    if missing:
+        # Months already being fetched by another session are waited for instead of fetched again
+        fetched = _flight.do_many(missing, lambda keys: _fetch_chunks(variableid, [chunk for _, chunk in keys],
+                                                                        headers, max_workers, store))
+        for (_, chunk), df in fetched.items():
+            frames[chunk] = df
+    df = pd.concat([frames[chunk] for chunk in chunks])
+    return df[(df.index >= start_ts) & (df.index <= end_ts)].copy()
+
+async def _fetch_multiple(mapping, start, end, apikey):
+    tasks = [asyncio.to_thread(get_data_from_fg_api_with_start_end, variableid, start, end, apikey)
+             for variableid in mapping.values()]
+    return await asyncio.gather(*tasks)
+
+
+def get_multiple_from_fg_api(mapping, start, end, apikey=None):
+    """
+    Fetch several datasets concurrently. Requests are throttled by the shared rate limiter.
+    :param mapping: dictionary of column name -> dataset id
+    :param start: start date
+    :param end: end date
+    :param apikey: optional API key
+    :return: dataframe with one column per dataset, aligned by timestamp
+    """
+    dfs = asyncio.run(_fetch_multiple(mapping, start, end, apikey))
+    return pd.concat([df['Value'].rename(name) for name, df in zip(mapping.keys(), dfs)], axis=1)
 
-        df.drop(['End'], inplace=True, axis=1)
-    df['Aikaleima'] = pd.to_datetime(df['Aikaleima']).dt.tz_convert('Europe/Helsinki')
-    df.set_index('Aikaleima', inplace=True)
-    return df
 
+@metrics.timed('fingrid.search')
 def search_fg_api(searchkey, apikey):
     headers = {'x-api-key': apikey}
-    res = requests.api.get(f"https://data.fingrid.fi/api/datasets?search={searchkey}&orderBy=id",
-                    headers=headers)
+    res = request(f"{FG_API_URL}/datasets?search={searchkey}&orderBy=id", headers)
     res_decoded = res.content.decode('utf-8')
 
     response = json.loads(res_decoded)
@@ -1,15 +1,59 @@
 import datetime
-from fmiopendata.wfs import download_stored_query
+from fmiopendata.multipoint import MultiPoint
+from fmiopendata.wfs import STORED_QUERY_URL
 from concurrent.futures import ThreadPoolExecutor
-import asyncio
-import itertools
+import os
+import time
+import numpy as np
 import pandas as pd
+import requests
+from src import metrics, transport
+from src.singleflight import SingleFlight
 
 
-def get_temp(id, start_str, end_str):
-    print(f'task {id} executing {start_str} - {end_str}')
-    stations = ['Helsinki', 'Jämsä', 'Oulu', 'Rovaniemi']
+# Number of 168 hour windows downloaded concurrently and download attempts per window
+MAX_WORKERS = int(os.environ.get('FMI_MAX_WORKERS', 4))
+RETRIES = 3
+
+STATIONS = ['Helsinki', 'Jämsä', 'Oulu', 'Rovaniemi']
+
+# Sessions downloading the same window at the same time share one download
+_flight = SingleFlight('fmi')
+
+
+def _station_name(location):
+    """
+    Map FMI location name (e.g. 'Helsinki Kaisaniemi') to the queried place name
+    """
+    for station in STATIONS:
+        if location.startswith(station):
+            return station
+    return None
 
+
+def download_stored_query(query_id, args):
+    """
+    Download and parse a multipoint coverage stored query like fmiopendata's download_stored_query, but through the
+    shared transport, so downloads can be recorded, replayed and simulated
+    :param query_id: stored query id
+    :param args: list of query arguments
+    :return: parsed observations
+    """
+    args = list(args)
+    timeseries = 'timeseries=True' in args
+    if timeseries:
+        args.remove('timeseries=True')
+    res = transport.get_transport().get('&'.join([STORED_QUERY_URL + query_id] + args))
+    res.raise_for_status()
+    return MultiPoint(res.content, query_id, timeseries=timeseries)
+
+
+@metrics.timed('fmi.request')
+def get_temp(id, start_str, end_str):
+    """
+    Download hourly temperatures of the stations for a single window
+    :return: dictionary of station name -> (times, values) numpy arrays
+    """
     obs = download_stored_query("fmi::observations::weather::multipointcoverage",
                                 args=["starttime=" + start_str,
                                       "endtime=" + end_str,
@@ -18,26 +62,40 @@ def get_temp(id, start_str, end_str):
                                       "timeseries=True",
                                       "place=Helsinki&place=Oulu&place=Jämsä&place=Rovaniemi",
                                       "maxlocations=1"])
-    data = obs.data
     all_data = {}
-    i = 0
-    for key in data.keys():
-        times = data[key]['times']
-        values = data[key]['T']['values']
-
-        all_data[stations[i]] = {'times': times, 'values': values}
-        i += 1
+    for location, data in obs.data.items():
+        station = _station_name(location)
+        if station is None:
+            continue
+        all_data[station] = (np.array(data['times'], dtype='datetime64[s]'),
+                             np.array(data['T']['values'], dtype=np.float64))
     return all_data
 
 
-def temperatures(start_time, end_time):
+def get_temp_with_retry(id, start_str, end_str):
+    """
+    Download a single window, retrying with exponential backoff if the connection fails or the service responds with
+    a transient status, or after the time given in the Retry-After header if it is throttled. Other errors are raised
+    """
+    for attempt in range(RETRIES):
+        try:
+            return get_temp(id, start_str, end_str)
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            response = getattr(e, 'response', None)
+            transient = isinstance(e, requests.ConnectionError) or (
+                response is not None and response.status_code in transport.RETRY_STATUSES)
+            if not transient or attempt == RETRIES - 1:
+                raise
+            # Retries are counted and their waiting time is recorded in the metrics
+            with metrics.span('fmi.retry_wait', str(e)):
+                time.sleep(transport.retry_delay(response, attempt))
+
+
+@metrics.timed('fmi.temperatures')
+def temperatures(start_time, end_time, max_workers=MAX_WORKERS):
 
     curr_time = start_time
     end_time = pd.to_datetime(end_time)
-    monday1 = (curr_time - datetime.timedelta(days=curr_time.weekday()))
-    monday2 = (end_time - datetime.timedelta(days=end_time.weekday()))
-
-    weeks = (monday2 - monday1).days / 7
     # generate 168 hour periods due to API restrictions
     i = 1
     parameters = []
@@ -54,17 +112,25 @@ def temperatures(start_time, end_time):
 
     parameters.append(tuple((i, start_str, end_str)))
 
-    all_dfs = []
-    for week in parameters:
-        result = get_temp(*week)
-        cols = list(result.keys())
-        df = pd.DataFrame(columns=cols)
-        for col in cols:
-            df['Aikaleima'] = result[col]['times']
-            df[col] = result[col]['values']
-        all_dfs.append(df)
-    full_df = pd.concat(all_dfs)
-    full_df.set_index(['Aikaleima'], inplace=True)
-    full_df.interpolate(inplace=True, axis=1)
-    return full_df
+    # Preallocate the hourly grid for the whole range, rows are written by their offset from the start
+    grid_start = pd.Timestamp(start_time).floor('H').to_datetime64().astype('datetime64[s]')
+    grid_end = end_time.floor('H').to_datetime64().astype('datetime64[s]')
+    num_of_hours = int((grid_end - grid_start) // np.timedelta64(1, 'h')) + 1
+    values = np.full((num_of_hours, len(STATIONS)), np.nan)
 
+    # Download windows in parallel, the results are placed in the grid by timestamp so their order doesn't matter
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for result in executor.map(lambda week: _flight.do(week[1:], get_temp_with_retry, *week), parameters):
+            for station, (times, station_values) in result.items():
+                offsets = (times - grid_start) // np.timedelta64(1, 'h')
+                valid = (offsets >= 0) & (offsets < num_of_hours)
+                values[offsets[valid], STATIONS.index(station)] = station_values[valid]
+
+    full_df = pd.DataFrame(values, columns=STATIONS,
+                           index=pd.date_range(grid_start, periods=num_of_hours, freq='H', name='Aikaleima'))
+    full_df = full_df.dropna(how='all')
+    # Fill single missing station values from the other stations
+    missing = full_df.isna().any(axis=1)
+    if missing.any():
+        full_df.loc[missing] = full_df.loc[missing].interpolate(axis=1)
+    return full_df
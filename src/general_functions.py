@@ -3,11 +3,14 @@ import pandas as pd
 from streamlit_extras.mention import mention
 
 import datetime
+from src import metrics, storage
+from src.cache import cache_data
 
 
 
 def get_general_layout(start=None):
     # Start of the page
+    metrics.start_run()
     end = datetime.datetime.now()
     st.image('./src/EnergiaDashboard.png', width=1000)
     st.sidebar.subheader("Valitse aikaikkuna 📆")
@@ -73,7 +76,7 @@ def sidebar_contact_info():
 
 
 
-@st.cache_data(show_spinner=False, max_entries=200)
+@cache_data(show_spinner=False)
 def aggregate_data(df, aggregation_selection, agg_level='mean'):
     """
     Aggregates the given data based on user selected aggregation_selection level
@@ -102,9 +105,24 @@ def aggregate_data(df, aggregation_selection, agg_level='mean'):
     else:
         return df.resample(agg)
 
-def check_previous_data(old_df, start_time):
-    # Identify the last date in the existing data
-    if not old_df.empty:
-        return old_df.index.max() + datetime.timedelta(hours=1)
+def show_data_freshness(series):
+    """
+    Show when the locally stored data used by the page was last updated by the background ingestion
+    :param series: list of series names in the local store
+    """
+    if not storage.LOCAL_ONLY:
+        return
+    updated = [storage.updated_at(name) for name in series]
+    if None in updated:
+        st.caption("Osa datasta puuttuu vielä paikallisesta tietovarastosta.")
+    elif updated:
+        oldest = min(updated).tz_convert('Europe/Helsinki')
+        st.caption(f"Data päivitetty {oldest.strftime('%d.%m.%Y %H:%M')}")
+
+
+def check_previous_data(last_timestamp, start_time):
+    # Continue from the last timestamp in the existing data
+    if last_timestamp is not None:
+        return last_timestamp + datetime.timedelta(hours=1)
     else:
         return pd.to_datetime(start_time) - datetime.timedelta(hours=1)
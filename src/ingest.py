@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import time
+import traceback
+from src import catalogue
+from src.datasets import FINGRID_DATASETS, update_wind_corr_data, update_temperature_data
+from src.entsoapi import NORDIC_BALTIC_AREAS, update_area_price_data
+from src.fingridapi import get_data_from_fg_api_with_start_end
+
+
+"""
+Background ingestion that keeps the local store up to date, so pages started with ENERGIADATA_LOCAL_ONLY=1 never
+wait for the external APIs. Run from the repository root:
+
+    python -m src.ingest --interval 3600
+"""
+
+HISTORY_START = datetime.date(2018, 1, 1)
+
+
+def refresh_fingrid(start, end):
+    for variableid in FINGRID_DATASETS:
+        # Closed months are fetched only once, after that only the ongoing month is fetched again
+        get_data_from_fg_api_with_start_end(variableid, start, end, local_only=False)
+
+
+def refresh_prices(start, end):
+    update_area_price_data(NORDIC_BALTIC_AREAS, start, end)
+
+
+def refresh_wind_corr(start, end):
+    update_wind_corr_data(start, end)
+
+
+def refresh_temperatures(start, end):
+    update_temperature_data(datetime.datetime.combine(start, datetime.time()), end)
+
+
+def refresh_catalogue(start, end):
+    catalogue.refresh()
+
+
+JOBS = {'fingrid': refresh_fingrid,
+        'prices': refresh_prices,
+        'wind_corr': refresh_wind_corr,
+        'temperatures': refresh_temperatures,
+        'catalogue': refresh_catalogue}
+
+
+def run_once(start, jobs=JOBS):
+    """
+    Run every refresh job once. A failing job is reported and skipped, so one unavailable API doesn't stop the rest.
+    :param start: first date fetched for datasets that are not in the store yet
+    :param jobs: dictionary of job name -> refresh function
+    :return: list of failed job names
+    """
+    end = datetime.date.today()
+    failed = []
+    for name, job in jobs.items():
+        started = time.monotonic()
+        try:
+            job(start, end)
+            print(f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {name} refreshed in '
+                  f'{time.monotonic() - started:.1f} s')
+        except Exception:
+            print(f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {name} failed')
+            traceback.print_exc()
+            failed.append(name)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the local EnergiaData store up to date')
+    parser.add_argument('--interval', type=int, default=3600, help='seconds between refreshes')
+    parser.add_argument('--once', action='store_true', help='refresh once and exit')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=HISTORY_START,
+                        help='first date fetched for datasets that are not stored yet (YYYY-MM-DD)')
+    parser.add_argument('--jobs', nargs='+', choices=list(JOBS), default=list(JOBS), help='refresh only these')
+    args = parser.parse_args()
+
+    jobs = {name: JOBS[name] for name in args.jobs}
+    while True:
+        failed = run_once(args.start, jobs)
+        if args.once:
+            raise SystemExit(1 if failed else 0)
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
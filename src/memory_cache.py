@@ -0,0 +1,136 @@
+import collections
+import os
+import threading
+import time
+
+
+"""
+In-memory cache shared by all cached loaders of the process. The cache is limited by the total size of the cached
+values instead of their number, so a few multi-year frames and hundreds of one-week frames use the same budget. When
+a new value does not fit, expired values are dropped first and then the least recently used ones. The budget is set
+in megabytes with ENERGIADATA_CACHE_MB.
+"""
+
+CACHE_BYTES = int(float(os.environ.get('ENERGIADATA_CACHE_MB', 1024)) * 2 ** 20)
+
+
+class _Entry:
+    def __init__(self, name, value, nbytes, expires):
+        self.name = name
+        self.value = value
+        self.nbytes = nbytes
+        self.expires = expires
+
+
+class ByteBudgetCache:
+    """
+    Thread-safe LRU cache with a byte budget. Values are grouped by the name of the cached function for the limits
+    and statistics, the keys must be unique over all functions.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: total size of the cached values in bytes
+        """
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # Function name -> counters
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _function_stats(self, name):
+        return self._stats.setdefault(name, {'entries': 0, 'bytes': 0, 'evicted': 0, 'expired': 0, 'rejected': 0})
+
+    def _remove(self, key, reason=None):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.nbytes
+        stats = self._function_stats(entry.name)
+        stats['entries'] -= 1
+        stats['bytes'] -= entry.nbytes
+        if reason is not None:
+            stats[reason] += 1
+
+    def _remove_expired(self, now):
+        for key in [key for key, entry in self._entries.items() if entry.expires <= now]:
+            self._remove(key, 'expired')
+
+    def get(self, key):
+        """
+        :return: tuple of (True, value) if the key is cached and not expired, otherwise (False, None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry.expires <= time.monotonic():
+                self._remove(key, 'expired')
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry.value
+
+    def put(self, name, key, value, nbytes, ttl=None, max_entries=None):
+        """
+        Cache a value, evicting other values until it fits in the budget. Values larger than the whole budget are not
+        cached.
+        :param name: name of the cached function
+        :param key: hashable key of the value
+        :param value: value to cache
+        :param nbytes: size of the value in bytes
+        :param ttl: seconds the value is cached, no expiry if None
+        :param max_entries: maximum number of values cached for the function, no limit if None
+        """
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                self._function_stats(name)['rejected'] += 1
+                return
+            if self._bytes + nbytes > self.max_bytes:
+                self._remove_expired(now)
+            while self._bytes + nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)), 'evicted')
+            if max_entries is not None:
+                function_keys = [cached for cached, entry in self._entries.items() if entry.name == name]
+                for cached in function_keys[:max(0, len(function_keys) - max_entries + 1)]:
+                    self._remove(cached, 'evicted')
+            self._entries[key] = _Entry(name, value, nbytes, now + ttl if ttl is not None else float('inf'))
+            self._bytes += nbytes
+            stats = self._function_stats(name)
+            stats['entries'] += 1
+            stats['bytes'] += nbytes
+
+    def clear(self, name=None):
+        """
+        Remove the cached values
+        :param name: name of the function whose values are removed, all values if None
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if name is None or entry.name == name]:
+                self._remove(key)
+
+    def stats(self):
+        """
+        :return: dictionary of function name -> number and bytes of the cached values and the number of values
+            evicted to fit the budget, expired and rejected as too large
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def total_bytes(self):
+        """
+        :return: total size of the cached values in bytes
+        """
+        with self._lock:
+            return self._bytes
+
+
+shared = ByteBudgetCache(CACHE_BYTES)
+
+
+def stats():
+    """
+    Statistics of the shared cache per function
+    """
+    return shared.stats()
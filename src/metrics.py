@@ -0,0 +1,271 @@
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+import pandas as pd
+import streamlit as st
+from src import memory_cache, singleflight
+
+
+"""
+Lightweight timing spans and cache counters. Spans are aggregated for the whole process and, for the script run that
+started them, collected for the debug panel in the sidebar (shown with ENERGIADATA_DEBUG=1 or ?debug=1 in the url).
+Process-wide metrics, including the size of the in-memory cache per function, are written in Prometheus text format
+to ENERGIADATA_METRICS_FILE, if set, to be scraped e.g. with the textfile collector of node_exporter.
+"""
+
+METRICS_FILE = os.environ.get('ENERGIADATA_METRICS_FILE')
+# Seconds between writes of the metrics file
+METRICS_INTERVAL = float(os.environ.get('ENERGIADATA_METRICS_INTERVAL', 15))
+DEBUG = os.environ.get('ENERGIADATA_DEBUG', '0') == '1'
+
+# Span name -> [count, total seconds, max seconds]
+_spans = {}
+# (cache name, result) -> count
+_cache_counts = {}
+# Dataset -> [frames, bytes with the original dtypes, bytes with compact dtypes]
+_memory = {}
+_lock = threading.Lock()
+_writer = None
+
+
+class _Run:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.cache_counts = {}
+
+
+# Script run collecting spans, set in the script thread. Threads started with asyncio.to_thread copy it, threads of
+# executors don't, so spans of pooled workers only show in the process-wide metrics.
+_run = contextvars.ContextVar('metrics_run', default=None)
+_depth = contextvars.ContextVar('metrics_depth', default=0)
+
+
+def start_run():
+    """
+    Start collecting the spans of the current script run for the debug panel
+    """
+    _run.set(_Run())
+    _depth.set(0)
+    _start_writer()
+
+
+def _record(name, label, seconds, depth, started):
+    with _lock:
+        totals = _spans.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+    run = _run.get()
+    if run is not None:
+        run.spans.append((started - run.started, depth, name, label, seconds))
+
+
+@contextlib.contextmanager
+def span(name, label=None):
+    """
+    Time the block
+    :param name: name of the span, e.g. 'fingrid.page'
+    :param label: optional detail shown in the debug panel but not in the aggregated metrics
+    """
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _depth.reset(token)
+        _record(name, label, time.perf_counter() - started, depth, started)
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function as a span
+    :param name: name of the span
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_cache(name, hit):
+    """
+    Count a cache lookup
+    :param name: name of the cache, e.g. the cached function
+    :param hit: True if the value was found in the cache
+    """
+    key = (name, 'hit' if hit else 'miss')
+    with _lock:
+        _cache_counts[key] = _cache_counts.get(key, 0) + 1
+    run = _run.get()
+    if run is not None:
+        run.cache_counts[key] = run.cache_counts.get(key, 0) + 1
+
+
+def record_memory(name, original, compact):
+    """
+    Record the memory of a loaded frame before and after converting it to compact dtypes
+    :param name: name of the dataset, e.g. the loader function
+    :param original: bytes with the original dtypes
+    :param compact: bytes with compact dtypes
+    """
+    with _lock:
+        totals = _memory.setdefault(name, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += original
+        totals[2] += compact
+
+
+def memory_report():
+    """
+    Memory saved by the compact dtypes per dataset since the process started
+    :return: dataframe with the number of frames, megabytes with the original and compact dtypes and the saved share
+    """
+    with _lock:
+        memory = {name: list(totals) for name, totals in _memory.items()}
+    report = pd.DataFrame.from_dict(memory, orient='index', columns=['Kehykset', 'Alkuperäinen (MB)', 'Tiivis (MB)'])
+    report[['Alkuperäinen (MB)', 'Tiivis (MB)']] /= 2 ** 20
+    report['Säästö (%)'] = (1 - report['Tiivis (MB)'] / report['Alkuperäinen (MB)']) * 100
+    return report.rename_axis('Aineisto').sort_index().round(1)
+
+
+def snapshot():
+    """
+    :return: copies of the process-wide span totals, cache counts and frame memory
+    """
+    with _lock:
+        return ({name: tuple(totals) for name, totals in _spans.items()}, dict(_cache_counts),
+                {name: tuple(totals) for name, totals in _memory.items()})
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+    """
+    Process-wide metrics in Prometheus text exposition format
+    """
+    spans, cache_counts, memory = snapshot()
+    lines = ['# HELP energiadata_span_seconds Time spent in instrumented code.',
+             '# TYPE energiadata_span_seconds summary']
+    for name, (count, total, _) in sorted(spans.items()):
+        lines.append(f'energiadata_span_seconds_count{{span="{_escape(name)}"}} {count}')
+        lines.append(f'energiadata_span_seconds_sum{{span="{_escape(name)}"}} {total:.6f}')
+    lines += ['# HELP energiadata_span_max_seconds Longest single span.',
+              '# TYPE energiadata_span_max_seconds gauge']
+    lines += [f'energiadata_span_max_seconds{{span="{_escape(name)}"}} {longest:.6f}'
+              for name, (_, _, longest) in sorted(spans.items())]
+    lines += ['# HELP energiadata_cache_lookups_total Cache lookups by result.',
+              '# TYPE energiadata_cache_lookups_total counter']
+    lines += [f'energiadata_cache_lookups_total{{cache="{_escape(name)}",result="{result}"}} {count}'
+              for (name, result), count in sorted(cache_counts.items())]
+    lines += ['# HELP energiadata_frame_bytes_total Memory of the loaded frames by dtypes.',
+              '# TYPE energiadata_frame_bytes_total counter']
+    for name, (_, original, compact) in sorted(memory.items()):
+        lines.append(f'energiadata_frame_bytes_total{{dataset="{_escape(name)}",dtypes="original"}} {original}')
+        lines.append(f'energiadata_frame_bytes_total{{dataset="{_escape(name)}",dtypes="compact"}} {compact}')
+    caches = memory_cache.stats()
+    lines += ['# HELP energiadata_cache_budget_bytes Size limit of the in-memory cache.',
+              '# TYPE energiadata_cache_budget_bytes gauge',
+              f'energiadata_cache_budget_bytes {memory_cache.shared.max_bytes}']
+    for counter, metric, kind, description in (('bytes', 'bytes', 'gauge', 'Size of the cached values.'),
+                                               ('entries', 'entries', 'gauge', 'Number of cached values.')):
+        lines += [f'# HELP energiadata_cache_{metric} {description}', f'# TYPE energiadata_cache_{metric} {kind}']
+        lines += [f'energiadata_cache_{metric}{{cache="{_escape(name)}"}} {stats[counter]}'
+                  for name, stats in sorted(caches.items())]
+    lines += ['# HELP energiadata_cache_removals_total Values removed from the cache or not cached by reason.',
+              '# TYPE energiadata_cache_removals_total counter']
+    lines += [f'energiadata_cache_removals_total{{cache="{_escape(name)}",reason="{reason}"}} {stats[reason]}'
+              for name, stats in sorted(caches.items()) for reason in ('evicted', 'expired', 'rejected')]
+    flights = singleflight.stats()
+    for counter, kind, description in (('calls', 'counter', 'Upstream fetches requested.'),
+                                       ('executed', 'counter', 'Upstream fetches executed.'),
+                                       ('coalesced', 'counter', 'Fetches served by a fetch already in flight.'),
+                                       ('in_flight', 'gauge', 'Upstream fetches in flight.')):
+        metric = f'energiadata_singleflight_{counter}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{{flight="{_escape(name)}"}} {stats[counter]}' for name, stats in sorted(flights.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path=None):
+    """
+    Write the process-wide metrics to the metrics file. The file is replaced atomically, so scrapers never read a
+    partial file.
+    :param path: file path, ENERGIADATA_METRICS_FILE by default
+    """
+    path = path or METRICS_FILE
+    if not path:
+        return
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def _write_periodically():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        try:
+            write_metrics()
+        except OSError as e:
+            print(f'Writing metrics to {METRICS_FILE} failed: {e}')
+
+
+def _start_writer():
+    global _writer
+    if not METRICS_FILE:
+        return
+    with _lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_periodically, name='metrics-writer', daemon=True)
+            _writer.start()
+
+
+def show_debug_panel():
+    """
+    Show the spans and cache lookups of the current script run in the sidebar, if debugging is enabled. Called at the
+    end of the page, so the whole run is included.
+    """
+    run = _run.get()
+    if run is None or not (DEBUG or st.query_params.get('debug') == '1'):
+        return
+    with st.sidebar.expander('Suorituskyky 🛠', expanded=True):
+        st.caption(f'Sivun ajo kesti {time.perf_counter() - run.started:.2f} s')
+        # Spans are recorded when they end, so nested spans are sorted before their parents by the start time
+        spans = sorted(run.spans, key=lambda recorded: recorded[:2])
+        st.dataframe(pd.DataFrame({
+            'Alku (ms)': [round(start * 1000) for start, *_ in spans],
+            'Vaihe': ['\u2003' * depth + name + (f' ({label})' if label else '') for _, depth, name, label, _ in spans],
+            'Kesto (ms)': [round(seconds * 1000, 1) for *_, seconds in spans],
+        }), hide_index=True, use_container_width=True)
+        caches = sorted({name for name, _ in run.cache_counts})
+        st.dataframe(pd.DataFrame({
+            'Välimuisti': caches,
+            'Osumat': [run.cache_counts.get((name, 'hit'), 0) for name in caches],
+            'Ohitukset': [run.cache_counts.get((name, 'miss'), 0) for name in caches],
+        }), hide_index=True, use_container_width=True)
+        st.dataframe(memory_report(), use_container_width=True)
+        caches = memory_cache.stats()
+        st.caption(f'Välimuistin koko {memory_cache.shared.total_bytes() / 2 ** 20:.1f} / '
+                   f'{memory_cache.shared.max_bytes / 2 ** 20:.0f} MB')
+        st.dataframe(pd.DataFrame({
+            'Välimuisti': list(caches),
+            'Arvot': [stats['entries'] for stats in caches.values()],
+            'Koko (MB)': [round(stats['bytes'] / 2 ** 20, 1) for stats in caches.values()],
+            'Poistetut': [stats['evicted'] for stats in caches.values()],
+            'Vanhentuneet': [stats['expired'] for stats in caches.values()],
+            'Liian suuret': [stats['rejected'] for stats in caches.values()],
+        }).sort_values('Välimuisti'), hide_index=True, use_container_width=True)
+        flights = singleflight.stats()
+        st.dataframe(pd.DataFrame(flights).T.rename(columns={'calls': 'Kutsut', 'executed': 'Haetut',
+                                                             'coalesced': 'Yhdistetyt', 'in_flight': 'Kesken'}),
+                     use_container_width=True)
@@ -0,0 +1,50 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are refilled at a steady rate up to the bucket capacity and every request
+    takes one token, waiting if the bucket is empty. A single bucket is shared by all sessions of the process.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens, i.e. the allowed burst size
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Take one token, blocking until one is available
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Take one token without waiting
+        :return: True if a token was available
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
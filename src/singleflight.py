@@ -0,0 +1,121 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Process-wide registry of in-flight upstream requests. Concurrent callers asking for the same key wait for the
+    request that is already running and share its result instead of sending their own, so e.g. many sessions missing
+    the same data at the same time cause only one request to the API.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: name shown in the coalescing metrics
+        """
+        self.name = name
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _claim(self, keys):
+        """
+        Register the keys that are not in flight yet for the caller, the rest are returned as calls to wait for
+        """
+        claimed, waiting = {}, {}
+        with self._lock:
+            for key in keys:
+                self.calls += 1
+                if key in self._in_flight:
+                    self.coalesced += 1
+                    waiting[key] = self._in_flight[key]
+                else:
+                    claimed[key] = self._in_flight[key] = _Call()
+            if claimed:
+                self.executed += 1
+        return claimed, waiting
+
+    def _finish(self, claimed, results=None, error=None):
+        with self._lock:
+            for key, call in claimed.items():
+                if error is None:
+                    call.result = results.get(key)
+                call.error = error
+                del self._in_flight[key]
+                call.done.set()
+
+    @staticmethod
+    def _wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn unless a call with the same key is already running, in which case its result is returned
+        :param key: hashable key identifying the request
+        :param fn: function doing the request
+        :return: result of fn
+        """
+        claimed, waiting = self._claim([key])
+        if waiting:
+            return self._wait(waiting[key])
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(claimed, error=e)
+            raise
+        self._finish(claimed, {key: result})
+        return result
+
+    def do_many(self, keys, fn):
+        """
+        Coalesce a request covering several keys (e.g. months of a dataset). Only keys that are not in flight are
+        passed to fn, results of the rest are taken from the requests already running. Overlapping requests therefore
+        share the common part.
+        :param keys: list of hashable keys
+        :param fn: function taking the list of claimed keys and returning a dictionary of key -> result
+        :return: dictionary of key -> result for all keys
+        """
+        claimed, waiting = self._claim(keys)
+        results = {}
+        if claimed:
+            try:
+                results = fn(list(claimed))
+            except BaseException as e:
+                self._finish(claimed, error=e)
+                raise
+            self._finish(claimed, results)
+        results = {key: results.get(key) for key in claimed}
+        for key, call in waiting.items():
+            results[key] = self._wait(call)
+        return results
+
+    def stats(self):
+        """
+        :return: dictionary with the number of calls, upstream requests and coalesced calls
+        """
+        with self._lock:
+            return {'calls': self.calls, 'executed': self.executed, 'coalesced': self.coalesced,
+                    'in_flight': len(self._in_flight)}
+
+
+_registry = []
+
+
+def stats():
+    """
+    Coalescing metrics of every registry in the process
+    :return: dictionary of registry name -> counters
+    """
+    return {flight.name: flight.stats() for flight in _registry}
@@ -0,0 +1,396 @@
+import contextlib
+import os
+import shutil
+import threading
+import pandas as pd
+from src import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, only threads of the same process are synchronized
+    fcntl = None
+
+
+"""
+Local time-series store. Each series is kept in monthly Parquet partitions
+(<store>/<series>/<year>/<month>.parquet) indexed by UTC timestamps, so reading a date window only touches the
+partitions overlapping it and appending new hours only rewrites the partitions the new data falls into.
+
+Writers of a series hold an exclusive lock of that series (shared between threads and processes) and every file is
+written to a temporary file that is then renamed over the old one, so readers never see partially written files.
+"""
+
+STORE_PATH = os.environ.get('ENERGIADATA_STORE', './data/store')
+# When the store is kept up to date by the background ingestion (src/ingest.py), pages only read local data
+LOCAL_ONLY = os.environ.get('ENERGIADATA_LOCAL_ONLY', '0') == '1'
+
+# Precomputed aggregates of every appended series, aggregation buckets follow Finnish local time
+ROLLUP_LEVELS = {'Tunti': 'H', 'Päivä': 'D', 'Viikko': 'W-MON', 'Kuukausi': 'MS'}
+ROLLUP_STATS = ['mean', 'sum', 'min', 'max', 'count']
+ROLLUP_TIMEZONE = 'Europe/Helsinki'
+
+# Old CSV caches are used to seed the store the first time a series is opened
+SEED_FILES = {'price_FI': './data/old_finnish_price_data.csv',
+              'wind_corr': './data/old_wind_corr_data.csv',
+              'temperatures': './data/old_temperatures.csv'}
+
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _series_path(series):
+    return os.path.join(STORE_PATH, series)
+
+
+@contextlib.contextmanager
+def locked(series):
+    """
+    Hold the exclusive write lock of the series. Lock files are kept outside the series directory, so taking the lock
+    doesn't create the series.
+    :param series: series name, or the name of any other file of the store written under the lock
+    """
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(series, threading.Lock())
+    lock_dir = os.path.join(STORE_PATH, '.locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with thread_lock, open(os.path.join(lock_dir, f'{series}.lock'), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def write_atomic(path, df):
+    """
+    Write the dataframe to a temporary Parquet file and atomically replace the target with it, so readers never see
+    a partially written file
+    :param path: path of the Parquet file
+    :param df: dataframe
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        df.to_parquet(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _partition_path(series, year, month):
+    return os.path.join(_series_path(series), f'{year:04d}', f'{month:02d}.parquet')
+
+
+def _rollup_path(series, freq):
+    return os.path.join(_series_path(series), '_rollups', f'{freq}.parquet')
+
+
+def _to_utc(timestamp):
+    """
+    Convert given timestamp to UTC. Naive timestamps are expected to be in UTC already.
+    """
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC')
+
+
+def _to_utc_index(df):
+    df = df.copy()
+    if df.index.tz is None:
+        df.index = df.index.tz_localize('UTC')
+    else:
+        df.index = df.index.tz_convert('UTC')
+    df.index.name = 'Aikaleima'
+    return df
+
+
+def _bootstrap(series):
+    """
+    Seed the store from the old CSV cache if the series has not been stored yet
+    """
+    seed_file = SEED_FILES.get(series)
+    if seed_file is None or os.path.isdir(_series_path(series)) or not os.path.exists(seed_file):
+        return
+    with locked(series):
+        if os.path.isdir(_series_path(series)):
+            return
+        df = pd.read_csv(seed_file)
+        df['Aikaleima'] = pd.to_datetime(df['Aikaleima'], utc=True)
+        df.set_index(['Aikaleima'], inplace=True)
+        # Build the series under a temporary name and rename it when complete, so other sessions never see a
+        # partially seeded series
+        temp_series = f'.bootstrap_{series}'
+        shutil.rmtree(_series_path(temp_series), ignore_errors=True)
+        _append(temp_series, df)
+        os.rename(_series_path(temp_series), _series_path(series))
+
+
+def partitions(series):
+    """
+    List the stored partitions of given series
+    :param series: series name
+    :return: sorted list of (year, month) tuples
+    """
+    _bootstrap(series)
+    path = _series_path(series)
+    if not os.path.isdir(path):
+        return []
+    result = []
+    for year in os.listdir(path):
+        if not year.isdigit():
+            continue
+        for month_file in os.listdir(os.path.join(path, year)):
+            month, ext = os.path.splitext(month_file)
+            if ext == '.parquet' and month.isdigit():
+                result.append((int(year), int(month)))
+    return sorted(result)
+
+
+@metrics.timed('storage.read')
+def read(series, start=None, end=None):
+    """
+    Read the given series between start and end (inclusive). Only partitions overlapping the window are loaded.
+    :param series: series name
+    :param start: start timestamp, naive values are interpreted as UTC
+    :param end: end timestamp, naive values are interpreted as UTC
+    :return: dataframe indexed by UTC timestamps
+    """
+    start = _to_utc(start) if start is not None else None
+    end = _to_utc(end) if end is not None else None
+    dfs = []
+    for year, month in partitions(series):
+        if start is not None and (year, month) < (start.year, start.month):
+            continue
+        if end is not None and (year, month) > (end.year, end.month):
+            continue
+        dfs.append(pd.read_parquet(_partition_path(series, year, month)))
+    if not dfs:
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz='UTC', name='Aikaleima'))
+    df = pd.concat(dfs)
+    return df.loc[start:end]
+
+
+@metrics.timed('storage.append')
+def append(series, df):
+    """
+    Add new rows to the series. Only the partitions the new rows fall into are rewritten and rows with already
+    stored timestamps replace the old values.
+    :param series: series name
+    :param df: dataframe with a datetime index, naive timestamps are interpreted as UTC
+    """
+    if df.empty:
+        return
+    with locked(series):
+        _append(series, df)
+
+
+def _append(series, df):
+    df = _to_utc_index(df)
+    for (year, month), part in df.groupby([df.index.year, df.index.month]):
+        path = _partition_path(series, year, month)
+        if os.path.exists(path):
+            part = pd.concat([pd.read_parquet(path), part])
+            part = part[~part.index.duplicated(keep='last')]
+        write_atomic(path, part.sort_index())
+    _update_rollups(series, df.index.min())
+
+
+def _update_rollups(series, since=None):
+    """
+    Recompute the rollup buckets affected by data added since the given timestamp. Without a timestamp or if the
+    rollups don't exist yet, the rollups are computed from the whole series.
+    """
+    paths = {freq: _rollup_path(series, freq) for freq in ROLLUP_LEVELS.values()}
+    if since is None or not all(os.path.exists(path) for path in paths.values()):
+        since = None
+        raw = read(series)
+    else:
+        # Start over a month before the new data so that every level has at least one complete bucket before it.
+        # The first, possibly partial bucket is dropped and old buckets are kept until the recomputed ones start.
+        window_start = since.tz_convert(ROLLUP_TIMEZONE).normalize() - pd.Timedelta(days=38)
+        raw = read(series, window_start)
+        # Nothing is stored before the window, so the first bucket is complete
+        first_partition = read_partition(series, *partitions(series)[0])
+        if first_partition.empty or first_partition.index.min() >= window_start:
+            since = None
+    if raw.empty:
+        return
+    raw.index = raw.index.tz_convert(ROLLUP_TIMEZONE)
+    for freq, path in paths.items():
+        rollup = raw.resample(freq).agg(ROLLUP_STATS)
+        rollup.columns = [f'{column}|{stat}' for column, stat in rollup.columns]
+        if since is not None:
+            rollup = rollup.iloc[1:]
+            old = pd.read_parquet(path)
+            rollup = pd.concat([old[old.index < rollup.index.min()], rollup]) if not rollup.empty else old
+        write_atomic(path, rollup)
+
+
+def _bucket(timestamp, freq):
+    # Label of the rollup bucket the timestamp falls into, resampling decides the bucket edges like for the rollups
+    return pd.Series(0, index=pd.DatetimeIndex([timestamp])).resample(freq).count().index[0]
+
+
+def _clipped_buckets(series, freq, start, end):
+    """
+    Aggregate the raw data between start and end (inclusive) like the rollups
+    """
+    raw = read(series, start, end)
+    raw.index = raw.index.tz_convert(ROLLUP_TIMEZONE)
+    buckets = raw.resample(freq).agg(ROLLUP_STATS)
+    buckets.columns = [f'{column}|{stat}' for column, stat in buckets.columns]
+    return buckets
+
+
+@metrics.timed('storage.read_rollup')
+def read_rollup(series, aggregation_selection, start=None, end=None, stat='mean'):
+    """
+    Read precomputed aggregates of the series instead of resampling the raw data. The buckets at the edges of the
+    range that are only partly inside it are recomputed from the raw data inside the range, so the result equals
+    resampling the data between start and end.
+    :param series: series name
+    :param aggregation_selection: aggregation level (Tunti, Päivä, Viikko or Kuukausi)
+    :param start: start timestamp, naive values are interpreted as UTC
+    :param end: end timestamp (inclusive), naive values are interpreted as UTC
+    :param stat: aggregate to return (mean, sum, min, max or count)
+    :return: dataframe with the original column names indexed by bucket labels in Finnish time
+    """
+    freq = ROLLUP_LEVELS[aggregation_selection]
+    path = _rollup_path(series, freq)
+    if not os.path.exists(path) and partitions(series):
+        with locked(series):
+            if not os.path.exists(path):
+                _update_rollups(series)
+    if not os.path.exists(path):
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz=ROLLUP_TIMEZONE, name='Aikaleima'))
+    rollup = pd.read_parquet(path)
+    partial = set()
+    if start is not None:
+        start = _to_utc(start).tz_convert(ROLLUP_TIMEZONE)
+        first = _bucket(start, freq)
+        rollup = rollup[rollup.index >= first]
+        if _bucket(start - pd.Timedelta(1), freq) == first:
+            partial.add(first)
+    if end is not None:
+        end = _to_utc(end).tz_convert(ROLLUP_TIMEZONE)
+        last = _bucket(end, freq)
+        rollup = rollup[rollup.index <= last]
+        if _bucket(end + pd.Timedelta(1), freq) == last:
+            partial.add(last)
+    if partial:
+        clipped = []
+        for label in sorted(partial):
+            # A bucket is at most a month long, so the raw data of a month around its label covers it
+            window_start, window_end = label - pd.Timedelta(days=32), label + pd.Timedelta(days=32)
+            window_start = max(start, window_start) if start is not None else window_start
+            window_end = min(end, window_end) if end is not None else window_end
+            buckets = _clipped_buckets(series, freq, window_start, window_end)
+            clipped.append(buckets[buckets.index == label])
+        rollup = pd.concat([rollup.drop(sorted(partial), errors='ignore')] + clipped).sort_index()
+    rollup = rollup[[column for column in rollup.columns if column.endswith(f'|{stat}')]]
+    rollup.columns = [column.rsplit('|', 1)[0] for column in rollup.columns]
+    return rollup
+
+
+def read_partition(series, year, month):
+    """
+    Read a single partition of the series
+    :param series: series name
+    :param year: partition year (UTC)
+    :param month: partition month (UTC)
+    :return: dataframe indexed by UTC timestamps or None if the partition is not stored
+    """
+    path = _partition_path(series, year, month)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def write_partition(series, year, month, df):
+    """
+    Replace a single partition of the series as is. Unlike append, empty frames and duplicate timestamps are kept,
+    so a stored partition can also record that a month has no data.
+    :param series: series name
+    :param year: partition year (UTC)
+    :param month: partition month (UTC)
+    :param df: dataframe with a datetime index, naive timestamps are interpreted as UTC
+    """
+    with locked(series):
+        write_atomic(_partition_path(series, year, month), _to_utc_index(df))
+
+
+def delete_partition(series, year, month):
+    """
+    Remove a single partition of the series if it is stored
+    :param series: series name
+    :param year: partition year (UTC)
+    :param month: partition month (UTC)
+    """
+    with locked(series):
+        path = _partition_path(series, year, month)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _gaps_path(series):
+    return os.path.join(STORE_PATH, '.gaps', f'{series}.parquet')
+
+
+def known_gaps(series):
+    """
+    Days recorded as having no data upstream, so they are not requested again
+    :param series: series name
+    :return: DatetimeIndex of the first moments of the days
+    """
+    path = _gaps_path(series)
+    if not os.path.exists(path):
+        return pd.DatetimeIndex([], tz='UTC', name='Aikaleima')
+    return pd.read_parquet(path).index
+
+
+def add_known_gaps(series, days):
+    """
+    Record days that have no data upstream. Gaps are kept outside the series directory, so recording them doesn't
+    create the series.
+    :param series: series name
+    :param days: DatetimeIndex of the first moments of the days
+    """
+    if len(days) == 0:
+        return
+    with locked(series):
+        gaps = known_gaps(series).union(pd.DatetimeIndex(days).tz_convert('UTC')).rename('Aikaleima')
+        write_atomic(_gaps_path(series), pd.DataFrame(index=gaps))
+
+
+def updated_at(series):
+    """
+    Get the time the series was last written to
+    :param series: series name
+    :return: UTC timestamp or None if the series is empty
+    """
+    stored = partitions(series)
+    if not stored:
+        return None
+    modified = max(os.path.getmtime(_partition_path(series, *partition)) for partition in stored[-2:])
+    return pd.Timestamp(modified, unit='s', tz='UTC')
+
+
+def last_timestamp(series):
+    """
+    Get the last stored timestamp of the series
+    :param series: series name
+    :return: UTC timestamp or None if the series is empty
+    """
+    stored = partitions(series)
+    if not stored:
+        return None
+    df = pd.read_parquet(_partition_path(series, *stored[-1]))
+    if df.empty:
+        return None
+    return df.index.max()
@@ -0,0 +1,301 @@
+import hashlib
+import http
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from src.ratelimit import TokenBucket
+
+
+"""
+HTTP transport shared by the Fingrid, ENTSO-E and FMI clients. The transport is selected with ENERGIADATA_TRANSPORT:
+
+    live    requests are sent to the APIs (default)
+    record  requests are sent to the APIs and the responses are stored in ENERGIADATA_RECORDINGS
+    replay  responses are served from ENERGIADATA_RECORDINGS without network access
+
+Any of the transports can be wrapped in a simulation adding latency, rate limiting (429 responses), failures and
+smaller pages, configured with the ENERGIADATA_SIM_* variables below. Together with replay this allows load testing
+fetch concurrency and caching on an isolated machine, e.g.
+
+    ENERGIADATA_TRANSPORT=replay ENERGIADATA_SIM_LATENCY=0.5 ENERGIADATA_SIM_RATE_LIMIT=2 streamlit run Info.py
+"""
+
+RECORDINGS_PATH = os.environ.get('ENERGIADATA_RECORDINGS', './data/recordings')
+
+# Statuses of transient errors, requests responded with these are retried by the clients and never recorded
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Query parameters holding credentials, left out of the recordings
+SECRET_PARAMS = {'securityToken'}
+
+# Environment variable -> argument of SimulatedTransport
+SIMULATION_VARIABLES = {
+    'ENERGIADATA_SIM_LATENCY': 'latency',          # seconds added to every request
+    'ENERGIADATA_SIM_JITTER': 'jitter',            # maximum random seconds added on top of the latency
+    'ENERGIADATA_SIM_RATE_LIMIT': 'rate_limit',    # requests per second, requests above it are responded with 429
+    'ENERGIADATA_SIM_FAILURE_RATE': 'failure_rate',  # share of requests failing with a connection error
+    'ENERGIADATA_SIM_PAGE_SIZE': 'page_size',      # rows per page of paginated Fingrid responses
+    'ENERGIADATA_SIM_SEED': 'seed',                # seed of the random failures and jitter
+}
+
+
+class RecordingNotFound(LookupError):
+    """
+    Raised when a replayed request has not been recorded
+    """
+
+
+def response(url, status_code, content, headers=None):
+    """
+    Build a response object, so responses served from recordings and simulations behave like the real ones
+    :param url: requested url
+    :param status_code: HTTP status code
+    :param content: body as bytes
+    :param headers: dictionary of response headers
+    :return: requests.Response
+    """
+    res = requests.Response()
+    res.url = url
+    res.status_code = status_code
+    res.reason = http.HTTPStatus(status_code).phrase
+    res.headers = CaseInsensitiveDict(headers or {})
+    res.encoding = 'utf-8'
+    res._content = content
+    return res
+
+
+def retry_delay(res, attempt):
+    """
+    Seconds to wait before retrying a request, the Retry-After header of a throttled response if given, otherwise
+    exponential backoff. Retry-After is stretched by a random factor, so concurrent requests throttled at the same
+    time don't all retry at the same moment again.
+    :param res: failed response, None if the request raised
+    :param attempt: number of the failed attempt starting from 0
+    """
+    retry_after = res.headers.get('Retry-After') if res is not None else None
+    try:
+        return max(0.0, float(retry_after)) * (1 + random.random() * (attempt + 1))
+    except (TypeError, ValueError):
+        return 2 ** attempt
+
+
+def request_key(url, params=None):
+    """
+    Identify a request by its url and query parameters, regardless of their order and encoding. Credentials are left
+    out, so recordings made with one API key can be replayed with any other.
+    :return: canonical url of the request
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query) + list((params or {}).items())
+    query = sorted((key, str(value)) for key, value in query if key not in SECRET_PARAMS)
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query), fragment=''))
+
+
+class LiveTransport:
+    """
+    Requests sent to the APIs with a shared keep-alive session, so consecutive requests reuse the same connections
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            self._session.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        return self._session.get(url, params=params, headers=headers, **kwargs)
+
+
+class RecordingTransport:
+    """
+    Stores every response of the wrapped transport, except transient errors, for replaying later. Each response is
+    stored as a body file and a JSON file with the request, status and headers, named by a hash of the request.
+    """
+
+    def __init__(self, inner, path=RECORDINGS_PATH):
+        self.inner = inner
+        self.path = path
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        res = self.inner.get(url, params=params, headers=headers, **kwargs)
+        if res.status_code not in RETRY_STATUSES:
+            _write_recording(self.path, request_key(url, params), res)
+        return res
+
+
+class ReplayTransport:
+    """
+    Serves recorded responses without network access
+    """
+
+    def __init__(self, path=RECORDINGS_PATH):
+        self.path = path
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        key = request_key(url, params)
+        meta_file, body_file = _recording_files(self.path, key)
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            with open(body_file, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            raise RecordingNotFound(f'No recording of {key} in {self.path}') from None
+        return response(url, meta['status_code'], content, meta['headers'])
+
+
+def _recording_files(path, key):
+    name = hashlib.sha1(key.encode()).hexdigest()
+    host = urllib.parse.urlsplit(key).hostname or 'local'
+    return os.path.join(path, host, f'{name}.json'), os.path.join(path, host, f'{name}.body')
+
+
+def _write_recording(path, key, res):
+    meta_file, body_file = _recording_files(path, key)
+    os.makedirs(os.path.dirname(meta_file), exist_ok=True)
+    # Written to temporary files first, so concurrent replays never see a partial recording
+    for file, mode, content in ((body_file, 'wb', res.content),
+                                (meta_file, 'w', json.dumps({'url': key, 'status_code': res.status_code,
+                                                             'headers': dict(res.headers)}, indent=1))):
+        tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_file, mode) as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+
+class SimulatedTransport:
+    """
+    Wraps a transport with simulated network conditions. Requests are delayed by the latency, requests above the rate
+    limit are responded with 429 and a Retry-After header, and a share of the requests fail with a connection error.
+    With a page size set, paginated Fingrid responses are split into smaller pages, so the clients need more requests
+    for the same data. The complete responses are kept in memory for splitting, so this is meant for testing only.
+    """
+
+    def __init__(self, inner, latency=0.0, jitter=0.0, rate_limit=None, failure_rate=0.0, page_size=None, seed=None):
+        """
+        :param inner: transport serving the actual responses
+        :param latency: seconds added to every request
+        :param jitter: maximum random seconds added on top of the latency
+        :param rate_limit: allowed requests per second, no limit if None
+        :param failure_rate: share of requests failing with a connection error
+        :param page_size: rows per page of paginated responses, pages of the inner transport if None
+        :param seed: seed of the random failures and jitter
+        """
+        self.inner = inner
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.page_size = int(page_size) if page_size else None
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self._limiter = TokenBucket(rate=rate_limit, capacity=max(1, int(rate_limit))) if rate_limit else None
+        self._random = random.Random(seed)
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fails = self._random.random() < self.failure_rate
+        if delay > 0:
+            time.sleep(delay)
+        if self._limiter is not None and not self._limiter.try_acquire():
+            with self._lock:
+                self.throttled += 1
+            return response(url, 429, b'Too Many Requests',
+                            {'Retry-After': f'{1 / self._limiter.rate:.3g}', 'Content-Type': 'text/plain'})
+        if fails:
+            with self._lock:
+                self.failed += 1
+            raise requests.ConnectionError(f'Simulated failure of {url}')
+        if self.page_size and 'pageSize' in dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query)):
+            return self._paginated(url, headers, **kwargs)
+        return self.inner.get(url, params=params, headers=headers, **kwargs)
+
+    def _paginated(self, url, headers, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        page = int(query.pop('page', 1))
+        key = request_key(urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query))))
+        with self._lock:
+            rows = self._rows.get(key)
+        if rows is None:
+            # Collect all pages of the inner transport once, later pages are served from memory
+            rows, inner_page, last_page = [], 1, 1
+            while inner_page <= last_page:
+                inner_url = urllib.parse.urlunsplit(parts._replace(
+                    query=urllib.parse.urlencode({**query, 'page': inner_page})))
+                res = self.inner.get(inner_url, headers=headers, **kwargs)
+                if res.status_code != 200:
+                    return res
+                payload = json.loads(res.content)
+                rows.extend(payload['data'])
+                last_page = payload['pagination']['lastPage']
+                inner_page += 1
+            with self._lock:
+                self._rows[key] = rows
+        num_of_pages = max(1, math.ceil(len(rows) / self.page_size))
+        content = json.dumps({'data': rows[(page - 1) * self.page_size:page * self.page_size],
+                              'pagination': {'currentPage': page, 'lastPage': num_of_pages,
+                                             'perPage': self.page_size, 'total': len(rows)}}).encode()
+        return response(url, 200, content, {'Content-Type': 'application/json'})
+
+    def stats(self):
+        """
+        :return: dictionary with the number of requests, throttled requests and failed requests
+        """
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled, 'failed': self.failed}
+
+
+def from_environment():
+    """
+    Build the transport configured with the environment variables
+    """
+    mode = os.environ.get('ENERGIADATA_TRANSPORT', 'live')
+    if mode == 'live':
+        transport = LiveTransport()
+    elif mode == 'record':
+        transport = RecordingTransport(LiveTransport())
+    elif mode == 'replay':
+        transport = ReplayTransport()
+    else:
+        raise ValueError(f'Unknown ENERGIADATA_TRANSPORT {mode}, expected live, record or replay')
+    simulation = {argument: float(os.environ[variable]) for variable, argument in SIMULATION_VARIABLES.items()
+                  if os.environ.get(variable)}
+    if simulation:
+        transport = SimulatedTransport(transport, **simulation)
+    return transport
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    :return: transport shared by all clients of the process, built from the environment on first use
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = from_environment()
+        return _transport
+
+
+def set_transport(transport):
+    """
+    Replace the shared transport, e.g. with a fixture or a simulation in benchmarks
+    :param transport: object with a get(url, params=None, headers=None, **kwargs) method returning responses
+    """
+    global _transport
+    with _transport_lock:
+        _transport = transport
@@ -0,0 +1,82 @@
+import numpy as np
+from src import metrics
+
+
+"""
+LOWESS trendline fitted on binned data. Observations are grouped into equal width bins along the x axis and the
+local regressions are fitted on the bin means weighted by the number of observations in each bin, so the cost depends
+on the number of bins instead of the number of observations.
+"""
+
+# Number of bins, more bins follow the full LOWESS fit more closely
+TREND_BINS = 200
+# Share of the observations used for each local regression and the number of robustifying iterations, same as the
+# defaults of plotly's lowess trendline
+LOWESS_FRAC = 2 / 3
+LOWESS_ITERATIONS = 3
+
+
+def _bin_means(x, y, positions, bins, weights):
+    counts = np.bincount(positions, weights=weights, minlength=bins)
+    filled = counts > 0
+    bin_x = np.bincount(positions, weights=weights * x, minlength=bins)[filled] / counts[filled]
+    bin_y = np.bincount(positions, weights=weights * y, minlength=bins)[filled] / counts[filled]
+    return bin_x, bin_y, counts[filled]
+
+
+def _local_linear(bin_x, bin_y, weights, frac):
+    # Distance between every pair of bins, the neighbourhood of each bin is the nearest bins holding frac of the
+    # observations
+    distances = np.abs(bin_x[:, None] - bin_x[None, :])
+    order = np.argsort(distances, axis=1)
+    cumulative = np.cumsum(weights[order], axis=1)
+    nearest = np.minimum((cumulative < frac * weights.sum()).sum(axis=1), len(bin_x) - 1)
+    radius = np.take_along_axis(distances, order, axis=1)[np.arange(len(bin_x)), nearest]
+    radius = np.where(radius > 0, radius, np.finfo(np.float64).eps)
+
+    local_weights = (1 - np.clip(distances / radius[:, None], 0, 1) ** 3) ** 3 * weights[None, :]
+    total = local_weights.sum(axis=1)
+    mean_x = local_weights @ bin_x / total
+    mean_y = local_weights @ bin_y / total
+    dx = bin_x[None, :] - mean_x[:, None]
+    variance = (local_weights * dx ** 2).sum(axis=1)
+    covariance = (local_weights * dx * (bin_y[None, :] - mean_y[:, None])).sum(axis=1)
+    slope = np.divide(covariance, variance, out=np.zeros_like(covariance), where=variance > 0)
+    return mean_y + slope * (bin_x - mean_x)
+
+
+@metrics.timed('trendline.lowess')
+def binned_lowess(x, y, frac=LOWESS_FRAC, bins=TREND_BINS, iterations=LOWESS_ITERATIONS):
+    """
+    Fit a LOWESS curve (local linear regression with tricube weights) on binned data. Like in statsmodels, outliers
+    are downweighted on the robustifying iterations using the residuals of the individual observations.
+    :param x: x values
+    :param y: y values
+    :param frac: share of the observations used for each local regression
+    :param bins: number of bins
+    :param iterations: number of robustifying iterations
+    :return: x and y values of the fitted curve as numpy arrays
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    if len(x) == 0:
+        return x, y
+    edges = np.linspace(x.min(), x.max(), bins + 1)
+    positions = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, bins - 1)
+    robustness = np.ones_like(y)
+    for iteration in range(iterations + 1):
+        bin_x, bin_y, weights = _bin_means(x, y, positions, bins, robustness)
+        if len(bin_x) < 3:
+            return bin_x, bin_y
+        fitted = _local_linear(bin_x, bin_y, weights, frac)
+        if iteration == iterations:
+            break
+        # Bisquare weights of the residuals scaled by six times their median absolute value
+        residuals = np.abs(y - np.interp(x, bin_x, fitted))
+        scale = 6 * np.median(residuals)
+        if scale == 0:
+            break
+        robustness = (1 - np.clip(residuals / scale, 0, 1) ** 2) ** 2
+    return bin_x, fitted